@@ -1,12 +1,26 @@
 ﻿from quart import Quart
-import student, teacher, group, task, mark
+import student, teacher, group, task, mark, events, archive, monitor
 import asyncpg
 import asyncio
 from csv import reader
 import os
-from database import DatabaseHandler
-from managers import StudentManager, TeacherManager, GroupManager, TaskManager, MarkManager
+from managers import StudentManager, TeacherManager, GroupManager, TaskManager, MarkManager, ArchiveManager
 from utils import HTTPCode
+from schema import check_schema
+from auth import LoginThrottle
+from exceptions import DatabaseBusy
+import admission
+import capture
+import tenancy
+from tenancy import TenantScoped, use_tenant, tenant_urls, current_tenant
+import compression
+import profiling
+from write_behind import CompletionWriteBehind
+from purge import PurgeWorker
+from objects import AuthorizationCache
+import logging
+
+logger = logging.getLogger(__name__)
 
 # TODO: Test cache limits
 # TODO: Try and except for database inputs - move try and except into DatabaseHandler methods
@@ -27,21 +41,114 @@ def create_app():
     app.register_blueprint(group.bp)
     app.register_blueprint(task.bp)
     app.register_blueprint(mark.bp)
+    app.register_blueprint(events.bp)
+    app.register_blueprint(archive.bp)
+    app.register_blueprint(monitor.bp)
+    tenancy.register(app) # Sets the school the request is for
+    capture.register(app) # Records traffic for benchmarks/replay.py if CAPTURE_TRAFFIC is set, before anything can shed the request
+    admission.register(app) # Sheds requests with a 503 when the service is saturated
+    compression.register(app)
+    profiling.register(app) # Registered last so it stops profiling before the other after_request functions run
 
     @app.before_serving
     async def on_startup():
-        app.config['db_handler'] = await DatabaseHandler.create()
-        app.config['student_manager'] = StudentManager()
-        app.config['teacher_manager'] = TeacherManager()
-        app.config['group_manager'] = GroupManager()
-        app.config['task_manager'] = TaskManager()
-        app.config['mark_manager'] = MarkManager()
-        
+        app.config['loop_monitor'] = monitor.LoopMonitor(threshold = float(os.environ.get('LOOP_LAG_THRESHOLD', 0.1)))
+        app.config['loop_monitor'].start() # Records how long the event loop is blocked for, see GET /monitor/loop
+        tenants = list(tenant_urls())
+        app.config['db_handler'] = await tenancy.create_database_handlers() # One pool per tenant
+        for name in tenants:
+            with use_tenant(name):
+                await check_schema(app.config['db_handler']) # Warns if the indexes the managers rely on are missing
+
+        # Everything below has one instance per tenant, so that caches, events and background work never mix schools
+        app.config['event_broker'] = TenantScoped.build(tenants, lambda: events.EventBroker(app.config['db_handler']))
+        for name, broker in app.config['event_broker'].items():
+            with use_tenant(name):
+                await broker.start()
+        app.config['json_fast_path'] = bool(os.environ.get('JSON_FAST_PATH')) # List routes return JSON built by the database
+        app.config['completion_queue'] = None
+        if os.environ.get('WRITE_BEHIND_WINDOW'): # Seconds that task completion toggles are held for before being written
+            app.config['completion_queue'] = TenantScoped.build(tenants, lambda: started(CompletionWriteBehind(app.config['db_handler'], float(os.environ['WRITE_BEHIND_WINDOW']))))
+        app.config['authorization_cache'] = TenantScoped.build(tenants, lambda: AuthorizationCache(int(os.environ.get('AUTHORIZATION_CACHE_SIZE', 4096))))
+        app.config['student_manager'] = TenantScoped.build(tenants, StudentManager)
+        app.config['teacher_manager'] = TenantScoped.build(tenants, TeacherManager)
+        app.config['group_manager'] = TenantScoped.build(tenants, GroupManager)
+        app.config['task_manager'] = TenantScoped.build(tenants, TaskManager)
+        app.config['mark_manager'] = TenantScoped.build(tenants, MarkManager)
+        app.config['archive_manager'] = TenantScoped.build(tenants, ArchiveManager)
+        app.config['login_throttle'] = TenantScoped.build(tenants, LoginThrottle)
+        # Removes deleted students, teachers and groups in the background
+        app.config['purge_worker'] = TenantScoped.build(tenants, lambda: started(PurgeWorker(app.config['db_handler'], float(os.environ.get('PURGE_INTERVAL', 60)), int(os.environ.get('PURGE_BATCH_SIZE', 500)))))
+        app.config['ready'] = False
+        app.config['warm_up_task'] = asyncio.ensure_future(warm_up()) # Runs in the background so /ready can be polled meanwhile
+
+    def started(worker):
+        """Starts the background task of `worker` and returns it. The task keeps the current tenant."""
+        worker.start()
+        return worker
+
+    async def wait_for_database():
+        """Runs a health check on the current tenant's primary until it succeeds, waiting twice as long after each failure
+        (up to 30 seconds), so that a brief outage at startup doesn't leave the worker unready for good."""
+        delay = 1
+        while True:
+            try:
+                await app.config['db_handler'].execute("SELECT 1;")
+                return
+            except Exception:
+                logger.warning("Database health check for %s failed, retrying in %d seconds", current_tenant.get(), delay, exc_info = True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def warm_up():
+        """Waits until each tenant's pool is healthy and, if the WARM_UP environment variable is set, preloads the user caches
+        and the permission cache. Once this has finished the worker reports itself as ready."""
+        for tenant in tenant_urls():
+            with use_tenant(tenant):
+                await wait_for_database()
+                if os.environ.get('WARM_UP'):
+                    for name in ['teacher_manager', 'student_manager', 'group_manager', 'task_manager']:
+                        try:
+                            count = await app.config[name].warm_up()
+                            logger.info("Warmed up %s for %s with %d rows", name, tenant, count)
+                        except Exception:
+                            logger.exception("Warming up %s for %s failed", name, tenant) # A cold cache is only slower, so still become ready
+        app.config['ready'] = True
+
+    @app.after_serving
+    async def on_shutdown():
+        app.config['warm_up_task'].cancel()
+        app.config['loop_monitor'].close()
+        for name, worker in app.config['purge_worker'].items():
+            worker.close()
+        if app.config['completion_queue']:
+            for name, queue in app.config['completion_queue'].items():
+                with use_tenant(name):
+                    await queue.close() # Writes anything still queued before the pool closes
+        for name, db in app.config['db_handler'].items():
+            await db.close()
+
+    @app.errorhandler(DatabaseBusy)
+    async def database_busy(e):
+        return admission.shed_response(app.config['admission_controller'].retry_after) # No connection became free in time
+
     @app.route('/', methods = ['GET'])
     async def root():
         links_string = "{\"links\":{\"student\":\"" + student.bp.url_prefix + "\", \"teacher\":\"" + teacher.bp.url_prefix + "\", \"group\":\"" + group.bp.url_prefix + "\", \"task\":\"" + task.bp.url_prefix + "\", \"mark\":\"" + mark.bp.url_prefix + "\"}}"
         return links_string, HTTPCode.OK
 
+    @app.route('/ready', methods = ['GET'])
+    async def ready():
+        """Route for the load balancer, which reports OK once the worker has warmed up and while every tenant's database is reachable."""
+        if not app.config.get('ready'):
+            return '', HTTPCode.SERVICEUNAVAILABLE
+        try:
+            for name, db in app.config['db_handler'].items():
+                await db.fetchrow("SELECT 1;")
+        except Exception:
+            return '', HTTPCode.SERVICEUNAVAILABLE
+        return '', HTTPCode.OK
+
     return app
 
 app = create_app()
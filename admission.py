@@ -0,0 +1,92 @@
+from quart import request, g
+from os import environ
+from utils import HTTPCode
+
+class Priority:
+    """Enumeration that links integers to priority classes. Higher priority requests are admitted while the service is busier."""
+    HIGH = 0 # Logging in, submitting work and feedback
+    NORMAL = 1
+    LOW = 2 # Bulk listing, which can be retried later without losing anything
+
+# The fraction of `capacity` that may be in use for a request of each priority to still be admitted. This keeps the last
+# part of the capacity for high priority requests when the service is busy.
+PRIORITY_SHARES = {Priority.HIGH: 1.0, Priority.NORMAL: 0.8, Priority.LOW: 0.5}
+
+# Endpoints that aren't listed here are NORMAL priority.
+ROUTE_PRIORITIES = {
+    'student.auth': Priority.HIGH,
+    'teacher.auth': Priority.HIGH,
+    'student.password_reset': Priority.HIGH,
+    'task.task_completed': Priority.HIGH,
+    'task.prov_feedback': Priority.HIGH,
+    'task.prov_feedback_bulk': Priority.HIGH,
+    'student.get_students': Priority.LOW,
+    'teacher.get_teachers': Priority.LOW,
+    'group.get_groups': Priority.LOW,
+    'group.get_group_students': Priority.LOW,
+    'group.get_group_tasks': Priority.LOW,
+    'task.get_all_tasks': Priority.LOW,
+    'task.get_task_marks': Priority.LOW,
+    'mark.get_marks': Priority.LOW,
+}
+
+# The maximum number of requests to an endpoint that can be processed at once. Endpoints that aren't listed here are only limited by capacity.
+ROUTE_LIMITS = {
+    'student.get_students': 4,
+    'teacher.get_teachers': 4,
+    'group.get_groups': 8,
+    'group.get_group_students': 8,
+    'group.get_group_tasks': 8,
+    'task.get_all_tasks': 8,
+    'task.get_task_marks': 8,
+    'mark.get_marks': 8,
+}
+
+class AdmissionController:
+    """Counts the requests being processed and decides whether a new request should be admitted or shed. Shedding a request
+    straight away with a 503 is much cheaper than letting it queue for a database connection, so the service stays responsive
+    for the requests that are admitted."""
+    def __init__(self, capacity, retry_after = 1, *args, **kwargs):
+        self.capacity = capacity
+        self.retry_after = retry_after # Seconds that a shed client is told to wait before retrying
+        self.in_flight = 0
+        self.route_in_flight = {}
+
+    def admit(self, endpoint):
+        """Returns True and counts the request if a request to `endpoint` can be admitted, else returns False."""
+        priority = ROUTE_PRIORITIES.get(endpoint, Priority.NORMAL)
+        if self.in_flight >= self.capacity * PRIORITY_SHARES[priority]:
+            return False
+        if self.route_in_flight.get(endpoint, 0) >= ROUTE_LIMITS.get(endpoint, self.capacity):
+            return False
+        self.in_flight += 1
+        self.route_in_flight[endpoint] = self.route_in_flight.get(endpoint, 0) + 1
+        return True
+
+    def release(self, endpoint):
+        """Stops counting a request to `endpoint` that was admitted."""
+        self.in_flight -= 1
+        self.route_in_flight[endpoint] -= 1
+
+def shed_response(retry_after):
+    """The response given to requests that are shed."""
+    return '', HTTPCode.SERVICEUNAVAILABLE, {"Retry-After": str(retry_after)}
+
+def register(app):
+    """Adds admission control to every request that `app` handles. The number of requests processed at once is set by
+    the MAX_CONCURRENT_REQUESTS environment variable, which defaults to twice the size of the database pool."""
+    controller = AdmissionController(int(environ.get('MAX_CONCURRENT_REQUESTS', 40)))
+    app.config['admission_controller'] = controller
+
+    @app.before_request
+    async def admit_request():
+        if controller.admit(request.endpoint):
+            g.admitted_endpoint = request.endpoint
+        else:
+            return shed_response(controller.retry_after)
+
+    @app.teardown_request
+    async def release_request(exc):
+        endpoint = g.pop('admitted_endpoint', None)
+        if endpoint is not None:
+            controller.release(endpoint)
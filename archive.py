@@ -0,0 +1,15 @@
+from quart import Blueprint, current_app
+import json
+from utils import HTTPCode
+from auth import auth_needed, Auth
+
+bp = Blueprint("archive", __name__, url_prefix = "/archive")
+
+@bp.route('/', methods = ['POST'])
+@auth_needed(Auth.TEACHER)
+async def archive():
+    """Route that moves the tasks and marks of past academic years into the archive, so they are only returned when a past
+    `?year=` is asked for. It should be run once at the start of each academic year. Teacher authentication needed."""
+    archives = current_app.config['archive_manager']
+    counts = await archives.archive()
+    return json.dumps(counts), HTTPCode.OK
@@ -1,10 +1,12 @@
-﻿from quart import current_app, request
+﻿from quart import current_app, request, g
 from hashlib import sha256
 from os import urandom, environ
 import base64
 from functools import wraps
 import binascii # Used to catch exceptions when converting from Base64
+from datetime import datetime, timedelta
 from utils import HTTPCode, is_admin_code_valid
+from objects import Cache, Student, Teacher
 
 class Auth:
     """Enumeration that links integers to auth types. This is solely used for abstraction."""
@@ -30,6 +32,71 @@ Returns `username, password` or False if the request doesn't contain properly fo
     except binascii.Error: # Runs if the Authorization header is Base64 compliant
         return False
 
+class LoginThrottle:
+    """Counts failed logins per username and per IP address. Once a username or IP has more than its free attempts,
+    each further failure blocks it for twice as long as the last, up to `max_delay` seconds. Blocked logins are refused before
+    any hashing or database work is done. IPs get many more free attempts than usernames as a whole school shares one IP.
+    Failures are forgotten once there have been none for `window` seconds, so counts don't build up over the whole term."""
+    def __init__(self, username_attempts = 5, ip_attempts = 50, base_delay = 1, max_delay = 300, window = 900, *args, **kwargs):
+        self.failures = Cache(4096) # Key is ("username", username) or ("ip", ip), value is [failure count, blocked until, last failure]
+        self.free_attempts = {"username": username_attempts, "ip": ip_attempts}
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.window = timedelta(seconds = window)
+
+    def retry_after(self, username = None, ip = None):
+        """Returns the number of seconds until `username` and `ip`, whichever are given, may try to log in again, or 0 if they are not blocked."""
+        now = datetime.now()
+        wait = 0
+        for key in [(kind, value) for kind, value in [("username", username), ("ip", ip)] if value]:
+            entry = self.failures.get(key)
+            if entry and entry[1] > now:
+                wait = max(wait, int((entry[1] - now).total_seconds()) + 1)
+        return wait
+
+    def record(self, username, ip, success):
+        """Records the outcome of a login attempt. A successful login clears the failures for the username, but not the IP."""
+        if success:
+            self.failures.remove(("username", username))
+            return
+        now = datetime.now()
+        for key in [("username", username), ("ip", ip)]:
+            entry = self.failures.get(key)
+            if not entry or now - entry[2] > self.window:
+                entry = [0, now, now] # No recent failures, so start counting again
+            entry[0] += 1
+            entry[2] = now
+            over = entry[0] - self.free_attempts[key[0]]
+            if over > 0:
+                entry[1] = now + timedelta(seconds = min(self.base_delay * 2 ** (over - 1), self.max_delay))
+            self.failures.add(key, entry)
+
+def client_ip(request):
+    """Returns the IP of the client making `request`. Heroku's router appends the client IP to the end of X-Forwarded-For."""
+    return request.access_route[-1] if request.access_route else None
+
+def throttled_response(username, incoming = None, login = False):
+    """Returns a 429 response if `username` is blocked from logging in, else None. On the login routes (`login` is True) the
+    client's IP is checked too. Elsewhere the IP is only checked once the credentials have failed (see failed_response), so
+    that a shared school IP being blocked never stops a request with valid credentials.
+    `incoming` is the request or websocket being authenticated, and defaults to the current request."""
+    ip = client_ip(incoming or request) if login else None
+    retry_after = current_app.config['login_throttle'].retry_after(username, ip)
+    if retry_after:
+        return '', HTTPCode.TOOMANYREQUESTS, {"Retry-After": str(retry_after)}
+    return None
+
+def failed_response(incoming = None):
+    """Returns the response for credentials that failed: a 429 if the client's IP is blocked from logging in, else a 401."""
+    retry_after = current_app.config['login_throttle'].retry_after(ip = client_ip(incoming or request))
+    if retry_after:
+        return '', HTTPCode.TOOMANYREQUESTS, {"Retry-After": str(retry_after)}
+    return '', HTTPCode.UNAUTHORIZED
+
+def record_login(username, success, incoming = None):
+    """Records the outcome of a login attempt for `username` from the client's IP."""
+    current_app.config['login_throttle'].record(username, client_ip(incoming or request), bool(success))
+
 def auth_needed(authentication: Auth, provide_obj: bool = False):
     """A decorator / wrapper that continues with the wrapped function if correct authentication is given.
     An argument `auth_obj` is passed into the wrapped function if a teacher or student is used to authenticate the route."""
@@ -49,6 +116,9 @@ def auth_needed(authentication: Auth, provide_obj: bool = False):
                     return '', HTTPCode.UNAUTHORIZED # Improperly formatted Authorization header
                 else:
                     username, password = details # Unpacking tuple
+                    throttled = throttled_response(username)
+                    if throttled:
+                        return throttled
 
             if authentication == Auth.TEACHER:
                 authenticated = await teacher_manager.is_teacher_valid(username, password)
@@ -66,12 +136,16 @@ def auth_needed(authentication: Auth, provide_obj: bool = False):
             else:
                 raise ValueError("`authentication` is a neccessary argument") # Code to prevent me from forgetting the authentication argument
 
+            if username:
+                record_login(username, authenticated)
+
             if authenticated:
+                g.principal_role = {Student: "student", Teacher: "teacher"}.get(type(authenticated), "admin") # Recorded by capture.py
                 if provide_obj:
                     kwargs['auth_obj'] = authenticated # Passes the ID of the Authorizaiton header into functions key-word arguments. It can be referenced by putting 'auth_id' in function parameters
                 return await f(*args, **kwargs)
             else:
-                return '', HTTPCode.UNAUTHORIZED
+                return failed_response()
         return decorated_function
     return auth
 
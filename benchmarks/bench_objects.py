@@ -0,0 +1,48 @@
+"""Measures the memory and time cost of the data objects in objects.py. Run from the repository root with `python benchmarks/bench_objects.py`.
+`LegacyTask` is the layout used before the objects had __slots__ (an instance __dict__ plus the original row in `data`), for comparison."""
+import sys
+import os
+import tracemalloc
+from timeit import timeit
+from datetime import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from objects import Student, Task
+
+class LegacyTask:
+    def __init__(self, data):
+        self.data = data
+        self.id, self.group_id, self.title, self.description, self.date_set, self.date_due, self.max_score = data[:7]
+
+STUDENT_ROW = (1, "Adam", "Smith", "asmith1", "a" * 32, "b" * 64, 42)
+TASK_ROW = (1, 2, "Homework", "Answer questions 1 to 10 on page 42." * 5, datetime(2020, 9, 1, 9, 0), datetime(2020, 9, 8, 9, 0), 10)
+
+def memory_per_object(make, count = 10000):
+    """Returns the average number of bytes still allocated per object once the rows `make` was given have been dropped,
+    as happens after a query. The row's values themselves are shared, so only the containers are counted."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    rows = [list(TASK_ROW) for _ in range(count)]
+    objects = [make(row) for row in rows]
+    del rows
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / count
+
+def main():
+    print(f"Task memory per object:       {memory_per_object(Task.create_from):8.1f} bytes")
+    print(f"LegacyTask memory per object: {memory_per_object(LegacyTask):8.1f} bytes")
+
+    number = 100000
+    student = Student.create_from(STUDENT_ROW)
+    task = Task.create_from(TASK_ROW)
+    for name, statement in [
+        ("Student.create_from", lambda: Student.create_from(STUDENT_ROW)),
+        ("Task.create_from", lambda: Task.create_from(TASK_ROW)),
+        ("LegacyTask()", lambda: LegacyTask(TASK_ROW)),
+        ("Student.copy_with", lambda: student.copy_with(username = "asmith2")),
+        ("Task.__str__", lambda: str(task)),
+    ]:
+        print(f"{name + ':':29} {timeit(statement, number = number) / number * 1e6:8.2f} us")
+
+if __name__ == "__main__":
+    main()
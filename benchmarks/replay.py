@@ -0,0 +1,233 @@
+"""Replays traffic recorded with CAPTURE_TRAFFIC (see capture.py) against a local instance, to reproduce real load patterns
+such as the night before a deadline. Run from the repository root:
+
+    python benchmarks/replay.py seed --manifest seed.json
+    python benchmarks/replay.py run capture.jsonl --manifest seed.json --speed 4
+
+`seed` fills the database given by DATABASE_URL with synthetic teachers, students, groups, tasks and marks, and writes the
+IDs and usernames it made to the manifest. It refuses to run on a database that already has students unless --force is given.
+`run` sends every captured request at its original time divided by --speed, authenticated as a synthetic user with the captured
+role. IDs in the captured paths, query strings and forms are mapped onto the synthetic IDs, always mapping the same captured
+ID to the same synthetic one, so hot groups and tasks stay hot. Redacted form values are filled in with synthetic ones."""
+import sys
+import os
+import json
+import time
+import random
+import base64
+import asyncio
+import argparse
+import urllib.request
+import urllib.parse
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+PASSWORD = "replay-password"
+ID_NAMES = {"student": "students", "students": "students", "teacher": "teachers", "teacher_id": "teachers",
+    "group": "groups", "groups": "groups", "task": "tasks"} # Path segment or field name -> manifest list of IDs
+
+async def seed(args):
+    """Fills the database with synthetic data and writes the manifest."""
+    from database import DatabaseHandler
+    from schema import migrate
+    from auth import hash_func
+
+    db = await DatabaseHandler.create(pool_size = 2) # Kept small so it fits alongside a running app, see serve.py
+    await migrate(db)
+    existing = await db.fetchrow("SELECT COUNT(*) AS count FROM student;")
+    if existing.get("count") and not args.force:
+        sys.exit("The database already has students, use --force to seed it anyway")
+
+    salt, hashed = await hash_func(PASSWORD, os.urandom(16)) # Every synthetic user shares a password, so it is only hashed once. The salt is returned as hex
+    rng = random.Random(args.random_seed)
+    now = datetime.utcnow()
+
+    teacher_names = [f"replay_teacher{i}" for i in range(args.teachers)]
+    teachers = await db.fetch("""INSERT INTO teacher (forename, surname, username, title, password, salt)
+SELECT 'Replay', 'Teacher', u, 'Mx', $2, $3 FROM unnest($1::text[]) AS u RETURNING id, username;""", teacher_names, hashed, salt, primary = True)
+
+    group_teachers = [teacher.get("id") for teacher in teachers for _ in range(args.groups)]
+    groups = await db.fetch("""INSERT INTO group_tbl (teacher_id, name, subject)
+SELECT t, 'Replay group', 'Replay' FROM unnest($1::int[]) AS t RETURNING id;""", group_teachers, primary = True)
+    group_ids = [group.get("id") for group in groups]
+
+    student_names = [f"replay_student{i}" for i in range(len(group_ids) * args.students)]
+    students = await db.fetch("""INSERT INTO student (forename, surname, username, alps, password, salt)
+SELECT 'Replay', 'Student', u, 5, $2, $3 FROM unnest($1::text[]) AS u RETURNING id, username;""", student_names, hashed, salt, primary = True)
+    members = [(student.get("id"), group_ids[i // args.students]) for i, student in enumerate(students)]
+    await db.execute("INSERT INTO student_group (student_id, group_id) SELECT * FROM unnest($1::int[], $2::int[]);",
+        [student_id for student_id, _ in members], [group_id for _, group_id in members])
+
+    task_groups = [group_id for group_id in group_ids for _ in range(args.tasks)]
+    dates_due = [now + timedelta(days = rng.randint(-30, 30)) for _ in task_groups]
+    tasks = await db.fetch("""INSERT INTO task (group_id, title, description, date_set, date_due, max_score)
+SELECT g, 'Replay task', 'Synthetic task for replaying traffic.', d - interval '7 days', d, 10 FROM unnest($1::int[], $2::timestamp[]) AS x(g, d)
+RETURNING id, group_id;""", task_groups, dates_due, primary = True)
+
+    group_students = {}
+    for student_id, group_id in members:
+        group_students.setdefault(group_id, []).append(student_id)
+    marks = [(student_id, task.get("id")) for task in tasks for student_id in group_students[task.get("group_id")] if rng.random() < args.completed]
+    await db.execute("""INSERT INTO mark_tbl (student_id, task_id, has_completed) SELECT s, t, True FROM unnest($1::int[], $2::int[]) AS x(s, t);""",
+        [student_id for student_id, _ in marks], [task_id for _, task_id in marks])
+
+    manifest = {
+        "password": PASSWORD,
+        "teachers": [[teacher.get("id"), teacher.get("username")] for teacher in teachers],
+        "students": [[student.get("id"), student.get("username")] for student in students],
+        "groups": group_ids,
+        "tasks": [task.get("id") for task in tasks],
+    }
+    with open(args.manifest, "w") as f:
+        json.dump(manifest, f)
+    print(f"Seeded {len(teachers)} teachers, {len(group_ids)} groups, {len(students)} students, {len(tasks)} tasks and {len(marks)} marks")
+    await db.close()
+
+class Replayer:
+    """Turns captured records into requests against the synthetic data in `manifest`."""
+    def __init__(self, manifest, base_url, random_seed = None):
+        self.manifest = manifest
+        self.base_url = base_url.rstrip("/")
+        self.rng = random.Random(random_seed)
+        self.ids = {name: [x[0] if type(x) == list else x for x in manifest[name]] for name in ["students", "teachers", "groups", "tasks"]}
+
+    def map_id(self, name, value):
+        """Maps the captured ID `value` of the kind `name` (e.g. task) onto a synthetic ID, or returns it unchanged if it can't be."""
+        ids = self.ids.get(ID_NAMES.get(name))
+        if not ids or not str(value).isdigit():
+            return value
+        return str(ids[int(value) % len(ids)])
+
+    def path(self, record):
+        """Returns the captured path with its IDs mapped, e.g. /task/1234/mark -> /task/17/mark."""
+        segments = record["path"].split("/")
+        for i in range(1, len(segments)):
+            segments[i] = self.map_id(segments[i - 1], segments[i])
+        return "/".join(segments)
+
+    def form_value(self, key):
+        """Returns a synthetic value for the redacted form field `key`."""
+        if key in ID_NAMES:
+            return ",".join(self.map_id(key, self.rng.randrange(10 ** 6)) for _ in range(3 if key.endswith("s") else 1))
+        if key in ["date_due", "due_before", "due_after"]:
+            return (datetime.utcnow() + timedelta(days = 7)).strftime("%d/%m/%Y|%H:%M")
+        if key == "admin":
+            return os.environ.get("ADMIN", "")
+        if key in ["max_score", "score", "alps"]:
+            return str(self.rng.randint(0, 10))
+        if key == "completed":
+            return self.rng.choice(["true", "false"])
+        if key == "username":
+            return f"replay_new{self.rng.randrange(10 ** 9)}"
+        if key in ["password", "new_password"]:
+            return PASSWORD
+        return "Replayed " + key
+
+    def role(self, record):
+        """Returns the role to authenticate as, or None if the captured request had no Authorization header."""
+        if record.get("role") in ["student", "teacher"]:
+            return record["role"]
+        if record.get("authorization"):
+            return "student" if (record.get("endpoint") or "").startswith("student.") else "teacher"
+        return None
+
+    def build(self, record):
+        """Returns a urllib Request for the captured `record`."""
+        query = {key: self.map_id(key, value) for key, value in record.get("args", {}).items() if value != "<redacted>"}
+        url = self.base_url + self.path(record) + ("?" + urllib.parse.urlencode(query) if query else "")
+        headers, data = {}, None
+        role = self.role(record)
+        if role:
+            _, username = self.rng.choice(self.manifest[role + "s"])
+            headers["Authorization"] = base64.b64encode(f"{username}:{self.manifest['password']}".encode()).decode()
+        if record.get("json_items"):
+            students = self.ids["students"]
+            data = json.dumps([{"student": self.rng.choice(students), "score": self.rng.randint(0, 10), "feedback": "Replayed feedback"}
+                for _ in range(record["json_items"])]).encode()
+            headers["Content-Type"] = "application/json"
+        elif record.get("form") or record["method"] in ["POST", "PUT", "PATCH"]:
+            data = urllib.parse.urlencode({key: self.form_value(key) for key in record.get("form", [])}).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        return urllib.request.Request(url, data = data, headers = headers, method = record["method"])
+
+def send(request, timeout):
+    """Sends `request` and returns (status, seconds taken). Runs in a thread."""
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None # Connection failed or timed out
+    return status, time.perf_counter() - start
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+async def run(args):
+    """Replays the capture and prints the status codes and latencies of each endpoint."""
+    with open(args.manifest) as f:
+        replayer = Replayer(json.load(f), args.base_url, args.random_seed)
+    with open(args.capture) as f:
+        records = sorted((json.loads(line) for line in f if line.strip()), key = lambda record: record["time"])
+    if not records:
+        sys.exit("The capture is empty")
+
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(args.concurrency)
+    results = {} # Key is the endpoint, value is a list of (status, seconds taken)
+    start, first = time.monotonic(), records[0]["time"]
+
+    async def replay(record):
+        delay = (record["time"] - first) / args.speed - (time.monotonic() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        request = replayer.build(record)
+        result = await loop.run_in_executor(executor, send, request, args.timeout)
+        results.setdefault(record.get("endpoint") or record["path"], []).append(result)
+
+    await asyncio.gather(*(replay(record) for record in records))
+    executor.shutdown()
+
+    elapsed = time.monotonic() - start
+    print(f"Replayed {len(records)} requests in {elapsed:.1f}s (captured over {(records[-1]['time'] - first):.1f}s, speed {args.speed}x)")
+    print(f"{'endpoint':40} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses")
+    for endpoint, endpoint_results in sorted(results.items(), key = lambda item: -len(item[1])):
+        times = [seconds * 1000 for _, seconds in endpoint_results]
+        statuses = {}
+        for status, _ in endpoint_results:
+            statuses[status] = statuses.get(status, 0) + 1
+        print(f"{endpoint:40} {len(times):>6} {percentile(times, 0.5):>8.1f} {percentile(times, 0.95):>8.1f} {percentile(times, 0.99):>8.1f}  {statuses}")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Seeds synthetic data and replays captured traffic against it.")
+    parser.add_argument("--random-seed", type = int, default = None, help = "Seed for the random choices, so runs can be repeated")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    seed_parser = commands.add_parser("seed", help = "Fill DATABASE_URL with synthetic data")
+    seed_parser.add_argument("--manifest", default = "replay_manifest.json")
+    seed_parser.add_argument("--teachers", type = int, default = 20)
+    seed_parser.add_argument("--groups", type = int, default = 4, help = "Groups per teacher")
+    seed_parser.add_argument("--students", type = int, default = 25, help = "Students per group")
+    seed_parser.add_argument("--tasks", type = int, default = 30, help = "Tasks per group")
+    seed_parser.add_argument("--completed", type = float, default = 0.6, help = "Fraction of tasks each student has completed")
+    seed_parser.add_argument("--force", action = "store_true")
+
+    run_parser = commands.add_parser("run", help = "Replay a capture")
+    run_parser.add_argument("capture")
+    run_parser.add_argument("--manifest", default = "replay_manifest.json")
+    run_parser.add_argument("--base-url", default = "http://localhost:8000")
+    run_parser.add_argument("--speed", type = float, default = 1.0, help = "How many times faster than captured to replay")
+    run_parser.add_argument("--concurrency", type = int, default = 64, help = "Maximum requests in flight")
+    run_parser.add_argument("--timeout", type = float, default = 30)
+
+    args = parser.parse_args()
+    asyncio.run(seed(args) if args.command == "seed" else run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+from quart import request, g
+import os
+import asyncio
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Query string parameters and form fields whose values are never written, only their names
+SENSITIVE = {"admin", "password", "new_password", "old_password"}
+
+class TrafficRecorder:
+    """Appends a line of JSON to `path` for every request, which benchmarks/replay.py can replay. Only the metadata needed to
+    re-drive the request is kept: the route, method, the role of the user (student, teacher or admin), the query string and
+    the timing. The Authorization header and form values are never written, only the names of the form fields, so a capture
+    doesn't contain credentials or anything a student or teacher has written.
+    Every worker appends to the same file, so each record is written with a single unbuffered write to a file opened with
+    O_APPEND, which the OS puts at the end of the file whole, so records from different workers never mix."""
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    async def record(self, response):
+        """Writes the record for the current request, which has been answered with `response`."""
+        start = g.get("capture_start")
+        if start is None:
+            return # Started before capturing was set up
+        form, json_items = [], None
+        if request.method in ["POST", "PUT", "PATCH"]:
+            form = sorted((await request.form).keys())
+            if not form:
+                body = await request.get_json(force = True, silent = True)
+                json_items = len(body) if type(body) == list else None # Bulk routes, see POST /task/<id>/provide_feedback/bulk
+
+        record = {
+            "time": g.capture_time,
+            "duration": time.perf_counter() - start,
+            "endpoint": request.endpoint,
+            "rule": request.url_rule.rule if request.url_rule else None,
+            "path": request.path,
+            "method": request.method,
+            "role": g.get("principal_role"),
+            "authorization": "Authorization" in request.headers,
+            "args": {key: "<redacted>" if key in SENSITIVE else value for key, value in request.args.items()},
+            "form": form,
+            "json_items": json_items,
+            "status": response.status_code,
+        }
+        try:
+            # Written in a thread, as a write to a slow disk would otherwise block the event loop
+            await asyncio.get_running_loop().run_in_executor(None, os.write, self.fd, (json.dumps(record) + "\n").encode())
+        except OSError:
+            logger.exception("Writing to the traffic capture %s failed", self.path) # Never fails the request
+
+    def close(self):
+        os.close(self.fd)
+
+def register(app):
+    """Records every request to the file given by the CAPTURE_TRAFFIC environment variable, if it is set."""
+    path = os.environ.get('CAPTURE_TRAFFIC')
+    if not path:
+        return
+    recorder = TrafficRecorder(path)
+
+    @app.before_request
+    async def start_capture():
+        g.capture_time = time.time()
+        g.capture_start = time.perf_counter()
+
+    @app.after_request
+    async def capture_request(response):
+        await recorder.record(response)
+        return response
+
+    @app.after_serving
+    async def stop_capture():
+        recorder.close()
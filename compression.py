@@ -0,0 +1,58 @@
+from quart import request
+from quart.wrappers.response import DataBody
+from hashlib import sha1
+from os import environ
+import gzip
+from objects import Cache
+
+try:
+    import brotli # Optional, only gzip is offered if it isn't installed
+except ImportError:
+    brotli = None
+
+def compress(data, encoding):
+    """Compresses the bytes `data` using `encoding`, either br or gzip."""
+    if encoding == "br":
+        return brotli.compress(data, quality = 5)
+    return gzip.compress(data, compresslevel = 6)
+
+class Compressor:
+    """Compresses response bodies that are at least `threshold` bytes long using the best encoding the client accepts.
+    Compressed bodies are cached by the digest of the raw body, so the same hot response (e.g. a group's task list that
+    hundreds of students are polling) is only compressed once."""
+    def __init__(self, threshold = 1024, cache_size = 128, *args, **kwargs):
+        self.threshold = threshold
+        self.cache = Cache(cache_size) # Key is (encoding, digest of raw body), value is the compressed body
+        self.encodings = ["br", "gzip"] if brotli else ["gzip"]
+
+    def compressed(self, data, encoding):
+        """Returns `data` compressed with `encoding`, using the cache if it has been compressed before."""
+        key = (encoding, sha1(data).digest())
+        cached = self.cache.get(key)
+        if not cached:
+            cached = compress(data, encoding)
+            self.cache.add(key, cached)
+        return cached
+
+    async def process(self, response):
+        """Compresses `response` in place if it is large enough and the client accepts a supported encoding."""
+        response.vary.add("Accept-Encoding")
+        if not isinstance(response.response, DataBody) or "Content-Encoding" in response.headers:
+            return response # Streamed or already encoded
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if not encoding:
+            return response
+        data = await response.get_data()
+        if len(data) < self.threshold:
+            return response
+        response.set_data(self.compressed(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+def register(app):
+    """Adds response compression to `app`. Bodies smaller than COMPRESSION_THRESHOLD bytes (1024 by default) are not compressed."""
+    compressor = Compressor(int(environ.get('COMPRESSION_THRESHOLD', 1024)))
+
+    @app.after_request
+    async def compress_response(response):
+        return await compressor.process(response)
@@ -1,35 +1,188 @@
 ﻿import asyncpg
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from os import environ
 from datetime import datetime
+from exceptions import DatabaseBusy
+
+logger = logging.getLogger(__name__)
+
+# Set to True once a request has written to the primary. Quart runs each request in its own context so this is reset for every request,
+# and any reads made after a write in the same request go to the primary so that the request always sees its own writes.
+_pinned_to_primary = ContextVar("pinned_to_primary", default=False)
+
+class Replica:
+    """A read replica pool along with its last measured replication lag."""
+    def __init__(self, url, pool):
+        self.url = url
+        self.pool = pool
+        self.lag = None # Seconds behind the primary, None if the lag could not be measured
+        self.healthy = True
 
 class DatabaseHandler:
     """A class that is mainly used to reduce the amount of writing multiple async with statements everytime a DB connection is needed.
-Having my own class which uses composition also allows me to be more flexible, and means I can add implementation when necessary."""
+Having my own class which uses composition also allows me to be more flexible, and means I can add implementation when necessary.
+Reads (`fetch` and `fetchrow`) are sent to the read replicas given in the comma separated `DATABASE_REPLICA_URLS` environment variable,
+and writes (`execute`) are sent to the primary. If there are no healthy replicas then reads fall back to the primary."""
 
     @classmethod
-    async def create(cls, *args):
-        """Database creation method. This method can be called from non-async code and it allows async code to be executed."""
+    async def create(cls, url = None, replica_urls = None, pool_size = None, *args):
+        """Database creation method. This method can be called from non-async code and it allows async code to be executed.
+        `url` and `replica_urls` default to the DATABASE_URL and DATABASE_REPLICA_URLS environment variables. `pool_size` is the
+        most connections each pool opens, and defaults to DB_POOL_SIZE, which serve.py sets so all the workers fit within the database's limit."""
         self = DatabaseHandler()
-        self.pool = await asyncpg.create_pool(environ['DATABASE_URL'] + "?sslmode=require", max_size=20)
+        size = pool_size or int(environ.get('DB_POOL_SIZE', 20))
+        self.pool = await asyncpg.create_pool((url or environ['DATABASE_URL']) + "?sslmode=require", min_size=min(size, 10), max_size=size)
+        self.replicas = []
+        if replica_urls is None:
+            replica_urls = environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        for url in replica_urls:
+            if url.strip():
+                pool = await asyncpg.create_pool(url.strip() + "?sslmode=require", min_size=min(size, 10), max_size=size)
+                self.replicas.append(Replica(url.strip(), pool))
+        self.max_lag = float(environ.get('REPLICA_MAX_LAG', 5)) # Replicas further behind the primary than this (in seconds) are not read from
+        self.next_replica = 0
+        self.acquire_timeout = float(environ.get('DB_ACQUIRE_TIMEOUT', 5)) # Seconds to wait for a free connection before giving up with DatabaseBusy
+        self.lag_task = asyncio.ensure_future(self.monitor_lag()) if self.replicas else None
+        self.listener = None # Connection held for LISTEN, see DatabaseHandler.listen
+        self.channels = [] # The (channel, callback) pairs listened to, so they can be listened to again after reconnecting
+        self.reconnect_task = None
+        self.closing = False
         return self
 
-    async def fetch(self, sql, *params):
+    @property
+    def pinned(self):
+        """True if the current request has written to the primary, and so all its reads go to the primary."""
+        return _pinned_to_primary.get()
+
+    async def close(self):
+        """Closes all the connection pools."""
+        self.closing = True # So that the LISTEN connection closing isn't treated as it being lost
+        if self.lag_task:
+            self.lag_task.cancel()
+        if self.reconnect_task:
+            self.reconnect_task.cancel()
+        if self.listener:
+            await self.pool.release(self.listener)
+        for replica in self.replicas:
+            await replica.pool.close()
+        await self.pool.close()
+
+    async def monitor_lag(self, interval = 1):
+        """Background task that measures the replication lag of each replica every `interval` seconds."""
+        while True:
+            for replica in self.replicas:
+                try:
+                    async with replica.pool.acquire() as connection:
+                        replica.lag = await connection.fetchval("""SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END;""") # No lag if every received WAL record has been replayed
+                except (OSError, asyncpg.PostgresError, asyncio.TimeoutError):
+                    replica.lag = None
+                healthy = replica.lag is not None and replica.lag <= self.max_lag
+                if healthy != replica.healthy:
+                    logger.warning("Replica %s is now %s (lag %s)", replica.url, "healthy" if healthy else "unhealthy", replica.lag)
+                replica.healthy = healthy
+            await asyncio.sleep(interval)
+
+    async def listen(self, channel, callback):
+        """Calls `callback(connection, pid, channel, payload)` for every NOTIFY on `channel`. The first call takes a connection
+        from the primary pool which is kept for listening until the handler is closed."""
+        self.channels.append((channel, callback))
+        if not self.listener:
+            await self.connect_listener()
+        else:
+            await self.listener.add_listener(channel, callback)
+
+    async def connect_listener(self):
+        """Takes a connection from the primary pool for LISTEN, and listens on it to every channel given to `listen`."""
+        connection = await self.pool.acquire()
+        connection.add_termination_listener(self.on_listener_lost)
+        for channel, callback in self.channels:
+            await connection.add_listener(channel, callback)
+        self.listener = connection
+
+    def on_listener_lost(self, connection):
+        """Termination listener for the LISTEN connection, e.g. after a failover or the server closing it for being idle.
+        Without it no NOTIFY would arrive, so a new connection is made in the background. NOTIFYs sent meanwhile are missed."""
+        if self.closing or connection is not self.listener:
+            return
+        logger.warning("Lost the LISTEN connection, reconnecting")
+        self.listener = None
+        self.reconnect_task = asyncio.ensure_future(self.reconnect_listener(connection))
+
+    async def reconnect_listener(self, lost):
+        """Background task that replaces the lost LISTEN connection `lost`, waiting twice as long after each failure (up to 30 seconds)."""
+        try:
+            await self.pool.release(lost)
+        except Exception:
+            pass # The pool replaces a closed connection itself
+        delay = 1
+        while not self.listener:
+            try:
+                await self.connect_listener()
+                logger.info("Reconnected the LISTEN connection")
+            except Exception:
+                logger.warning("Reconnecting the LISTEN connection failed, retrying in %d seconds", delay, exc_info = True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def read_pool(self):
+        """Returns the pool that a read should be sent to. Replicas are used in turn, skipping any that are unhealthy."""
+        if self.pinned:
+            return self.pool
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self.next_replica]
+            self.next_replica = (self.next_replica + 1) % len(self.replicas)
+            if replica.healthy:
+                return replica.pool
+        return self.pool # No healthy replicas
+
+    async def fetch(self, sql, *params, primary = False):
         """Database method which executes a command, `sql`, and parameters, `params`, and returns the output.
-        Returns the sql output or [] if the command returns nothing."""
-        to_return = None
-        async with self.pool.acquire() as connection:
-            async with connection.transaction():
-                to_return = await connection.fetch(sql, *params)
+        Returns the sql output or [] if the command returns nothing. `primary` must be True if the command writes (e.g. INSERT ... RETURNING)."""
+        if primary:
+            _pinned_to_primary.set(True)
+            pool = self.pool
+        else:
+            pool = self.read_pool()
+
+        try:
+            to_return = await self._fetch(pool, sql, *params)
+        except (OSError, asyncpg.exceptions.ConnectionDoesNotExistError):
+            if pool is self.pool:
+                raise
+            to_return = await self._fetch(self.pool, sql, *params) # Replica is unreachable, read from the primary instead
         return (to_return if to_return else [])
 
-    async def fetchrow(self, sql, *params):
+    async def _fetch(self, pool, sql, *params):
+        """Internal method that runs `sql` inside a transaction on a connection from `pool`."""
+        async with self.acquire(pool) as connection:
+            async with connection.transaction():
+                return await connection.fetch(sql, *params)
+
+    @asynccontextmanager
+    async def acquire(self, pool):
+        """Acquires a connection from `pool`, raising DatabaseBusy if one does not become free within `acquire_timeout` seconds."""
+        try:
+            connection = await pool.acquire(timeout = self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise DatabaseBusy
+        try:
+            yield connection
+        finally:
+            await pool.release(connection)
+
+    async def fetchrow(self, sql, *params, primary = False):
         """Database method which executes `sql` with given `params` and returns the first element of the data returned."""
-        data = await self.fetch(sql, *params)
+        data = await self.fetch(sql, *params, primary = primary)
         return (data[0] if data else [])
 
     async def execute(self, sql, *params):
         """Database method which executes an sql command, `sql` with given parameters, `params`.
-        `params` are given as multiple arguments."""
-        async with self.pool.acquire() as connection:
+        `params` are given as multiple arguments. Returns the status of the last command, e.g. `DELETE 10`."""
+        _pinned_to_primary.set(True)
+        async with self.acquire(self.pool) as connection:
             async with connection.transaction():
-                await connection.execute(sql, *params)
+                return await connection.execute(sql, *params)
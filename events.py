@@ -0,0 +1,117 @@
+from quart import Blueprint, websocket, current_app
+import asyncio
+import json
+import logging
+from utils import HTTPCode
+from auth import get_auth_details, throttled_response, record_login, failed_response
+from objects import Student
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint("events", __name__, url_prefix = "/events")
+
+def reference(name, id):
+    """Gives the JSON reference object for `name` (e.g. task) with the given `id`, in the same shape as AbstractBaseObject.__str__."""
+    return {"reference": {"id": id, "link": "/" + name + "/" + str(id)}}
+
+class EventBroker:
+    """Passes events to the websockets that are subscribed to them. Events are published to a topic, which is either
+    ("group", group_id) for events every member of a group should see, or ("student", student_id) for events only one student should see.
+    Events are published with Postgres NOTIFY, and every worker LISTENs and passes them on to its own subscribers, so a client
+    gets the event whichever worker it is connected to."""
+    channel = "trackr_events"
+
+    def __init__(self, db, queue_size = 64, *args, **kwargs):
+        self.db = db
+        self.queue_size = queue_size
+        self.subscribers = {} # Key is a topic, value is the set of queues subscribed to it
+
+    async def start(self):
+        """Starts listening for events published by every worker."""
+        await self.db.listen(self.channel, self.on_notify)
+
+    def subscribe(self, topics):
+        """Returns a queue that receives every event published to any of `topics`."""
+        queue = asyncio.Queue(self.queue_size)
+        for topic in topics:
+            self.subscribers.setdefault(topic, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, queue, topics):
+        """Stops `queue` receiving events from `topics`."""
+        for topic in topics:
+            subscribers = self.subscribers.get(topic)
+            if subscribers:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self.subscribers[topic]
+
+    async def publish(self, topic, event):
+        """Publishes the dictionary `event` to `topic` on every worker. Events only tell clients to fetch again, so a failure is
+        logged rather than raised, as the change the event is about has already been made."""
+        try:
+            await self.db.execute("SELECT pg_notify($1, $2);", self.channel, json.dumps({"topic": list(topic), "event": event}))
+        except Exception:
+            logger.exception("Publishing an event to %s failed", topic)
+
+    async def publish_many(self, events):
+        """Publishes a list of (topic, event) on every worker with one query. Failures are logged, as in `publish`."""
+        if not events:
+            return
+        try:
+            await self.db.execute("SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload;", self.channel,
+                [json.dumps({"topic": list(topic), "event": event}) for topic, event in events])
+        except Exception:
+            logger.exception("Publishing %d events failed", len(events))
+
+    def on_notify(self, connection, pid, channel, payload):
+        """Listener callback that passes a published event to the subscribers on this worker."""
+        message = json.loads(payload)
+        self.dispatch(tuple(message["topic"]), message["event"])
+
+    def dispatch(self, topic, event):
+        """Puts `event` on the queue of every subscriber to `topic`. If a subscriber is too far behind the event is dropped for it,
+        which only means the client fetches a little later than it could have."""
+        for queue in self.subscribers.get(topic, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning("Dropped event for a slow subscriber to %s", topic)
+
+@bp.websocket('/')
+async def events():
+    """Websocket that sends an event whenever a task is set or changed in one of the user's groups, and, for students, whenever
+    they are given feedback. The Authorization header is checked once when connecting, in the same way as auth_needed(Auth.ANY)."""
+    details = get_auth_details(websocket)
+    if not details:
+        return '', HTTPCode.UNAUTHORIZED
+    username, password = details
+    throttled = throttled_response(username, websocket)
+    if throttled:
+        return throttled
+
+    student_manager = current_app.config['student_manager']
+    teacher_manager = current_app.config['teacher_manager']
+    user = await student_manager.is_student_valid(username, password) or await teacher_manager.is_teacher_valid(username, password)
+    record_login(username, user, websocket)
+    if not user:
+        return failed_response(websocket)
+
+    groups = current_app.config['group_manager']
+    if type(user) == Student:
+        user_groups = await groups.get(student_id = user.id)
+        topics = [("student", user.id)]
+    else:
+        user_groups = await groups.get(teacher_id = user.id)
+        topics = []
+    topics += [("group", group.id) for group in (user_groups or [])]
+
+    broker = current_app.config['event_broker']
+    queue = broker.subscribe(topics)
+    try:
+        await websocket.accept()
+        while True:
+            event = await queue.get()
+            await websocket.send(json.dumps(event))
+    finally:
+        broker.unsubscribe(queue, topics) # Runs when the client disconnects and the handler is cancelled
@@ -4,4 +4,8 @@ class UsernameTaken(Exception):
 
 class DateTimeParserError(Exception):
     """Exception raised when a datetime given is not parsable."""
+    pass
+
+class DatabaseBusy(Exception):
+    """Exception raised when a database connection could not be acquired in time because the pool is saturated."""
     pass
\ No newline at end of file
@@ -1,9 +1,10 @@
 ﻿from quart import Blueprint, request, current_app
-from utils import stringify, parse_datetime # Functions
+from utils import stringify, stringify_list, parse_datetime, parse_fields, parse_task_query # Functions
 from utils import HTTPCode # Enumeratons
 from auth import auth_needed, Auth
+from idempotency import idempotent
 from datetime import datetime, timedelta # For making a task and setting deadline
-from objects import Student
+from objects import Student, Group, Task
 from exceptions import DateTimeParserError
 
 bp = Blueprint("group", __name__, url_prefix = "/group")
@@ -11,17 +12,22 @@ bp = Blueprint("group", __name__, url_prefix = "/group")
 @bp.route('/', methods = ['GET'])
 @auth_needed(Auth.ANY, provide_obj = True)
 async def get_groups(auth_obj):
-    """Subroutine that gets all the groups. A student only has access to their groups, and a teacher can request all groups (be default) or their own by setting ?mine=True"""
+    """Subroutine that gets all the groups. A student only has access to their groups, and a teacher can request all groups (be default) or their own by setting ?mine=True
+    The attributes returned can be narrowed with ?fields=, e.g. ?fields=id,name"""
     groups = current_app.config['group_manager']
+    try:
+        fields = parse_fields(request.args.get("fields"), Group.public_fields())
+    except ValueError:
+        return '', HTTPCode.BADREQUEST
 
     if type(auth_obj) == Student:
-        data = await groups.get(student_id = auth_obj.id)
+        data = await groups.get(student_id = auth_obj.id, fields = fields)
     else:
         get_all_groups = request.args.get("mine") != "True"
         if get_all_groups:
-            data = await groups.get()
+            data = await groups.get(fields = fields)
         else:
-            data = await groups.get(teacher_id = auth_obj.id)
+            data = await groups.get(teacher_id = auth_obj.id, fields = fields)
 
     if not data:
         return '', HTTPCode.NOTFOUND
@@ -53,10 +59,8 @@ async def make_group(auth_obj):
         return '', HTTPCode.BADREQUEST # Not all necessary arguments given
 
     groups = current_app.config['group_manager']
-    await groups.create(auth_obj.id, name, subject)
-    teachers_groups = await groups.get(teacher_id = auth_obj.id)
-    new_group = max(teachers_groups, key = lambda x: x.id)
-    return '', HTTPCode.CREATED, {"Location":bp.url_prefix + "/" + str(new_group.id)}
+    group_id = await groups.create(auth_obj.id, name, subject)
+    return '', HTTPCode.CREATED, {"Location":bp.url_prefix + "/" + str(group_id)}
 
 @bp.route('/<id>', methods = ['DELETE'])
 @auth_needed(Auth.TEACHER)
@@ -149,9 +153,9 @@ async def join_group(id):
         return '', HTTPCode.BADREQUEST
 
     student_manager = current_app.config['student_manager']
-    students = [int(id) for id in raw_students.split(',') if id.isdigit() and await student_manager.get(int(id))]
-    for student_id in students:
-        await groups.add_student(student_id, int(id))
+    students = await student_manager.get_many(ids = [int(x) for x in raw_students.split(',') if x.isdigit()]) # Only students that exist
+    if students:
+        await groups.add_students(list(students), int(id))
     return '', HTTPCode.OK
 
 @bp.route('/<id>/leave', methods = ['POST'])
@@ -172,29 +176,34 @@ async def leave_group(id):
         return '', HTTPCode.BADREQUEST
 
     student_manager = current_app.config['student_manager']
-    students = [int(id) for id in raw_students.split(',') if id.isdigit() and await student_manager.get(int(id))]
-    for student_id in students:
-        await groups.remove_student(student_id, int(id))
+    students = await student_manager.get_many(ids = [int(x) for x in raw_students.split(',') if x.isdigit()]) # Only students that exist
+    if students:
+        await groups.remove_students(list(students), int(id))
     return '', HTTPCode.OK
 
 @bp.route('/<id>/students', methods = ['GET'])
 @auth_needed(Auth.TEACHER)
 async def get_group_students(id):
-    """Get all the students in a given group."""
+    """Get all the students in a given group. The attributes returned can be narrowed with ?fields=, e.g. ?fields=id,username"""
     if not id.isdigit():
         return '', HTTPCode.BADREQUEST
+    try:
+        fields = parse_fields(request.args.get("fields"), Student.public_fields())
+    except ValueError:
+        return '', HTTPCode.BADREQUEST
     
     groups = current_app.config['group_manager']
     group = await groups.get(group_id = int(id))
     if not group:
         return '', HTTPCode.NOTFOUND
 
-    data = await groups.students(int(id))
+    data = await groups.students(int(id), fields = fields)
     return stringify(data), HTTPCode.OK
 
 # -- TASKS --
 
 @bp.route('/<id>/task', methods = ['POST'])
+@idempotent
 @auth_needed(Auth.TEACHER)
 async def make_new_task(id):
     """Route that creates a new task for a given group. When providing the date due, it must be in UTC, and the format: dd/mm/yyyy|hh:mm"""
@@ -222,23 +231,31 @@ async def make_new_task(id):
 
     tasks = current_app.config['task_manager']
     try:
-        await tasks.create(int(id), title, description, date_due, int(max_score))
-        all_tasks = await tasks.get(group_id = int(id))
-        new_task = max(all_tasks, key = lambda x: x.id)
-        return '', HTTPCode.CREATED, {"Location": "/task/" + str(new_task.id)}
+        task_id = await tasks.create(int(id), title, description, date_due, int(max_score))
+        return '', HTTPCode.CREATED, {"Location": "/task/" + str(task_id)}
     except Exception as e:
         return '', HTTPCode.BADREQUEST
 
 @bp.route('/<id>/task', methods = ['GET'])
 @auth_needed(Auth.ANY)
 async def get_group_tasks(id):
-    """Route that gets all the tasks relating to a group. Any authentication level needed."""
+    """Route that gets all the tasks relating to a group. Any authentication level needed.
+    The attributes returned can be narrowed with ?fields=, e.g. ?fields=id,title,date_due
+    The tasks can be filtered and sorted with ?due_before=, ?due_after=, ?sort= and ?limit=, see parse_task_query.
+    Tasks from a past academic year are returned from the archive with ?year=."""
     if not id.isdigit():
         return '', HTTPCode.BADREQUEST
+    try:
+        fields = parse_fields(request.args.get("fields"), Task.public_fields())
+        filters = parse_task_query(request.args)
+    except (ValueError, DateTimeParserError):
+        return '', HTTPCode.BADREQUEST
+    if "completed" in filters:
+        return '', HTTPCode.BADREQUEST # Completion is per student, so can only be filtered on /task/
 
     tasks = current_app.config['task_manager']
-    data = await tasks.get(group_id = int(id))
+    data = await tasks.get(group_id = int(id), fields = fields, as_json = current_app.config.get('json_fast_path', False), **filters)
     if not data:
         return '', HTTPCode.NOTFOUND
     else:
-        return stringify(data), HTTPCode.OK
\ No newline at end of file
+        return stringify_list(data), HTTPCode.OK
\ No newline at end of file
@@ -0,0 +1,86 @@
+from quart import request, current_app, make_response
+from functools import wraps
+from hashlib import sha256
+from os import environ
+import hmac
+import json
+import logging
+from utils import HTTPCode
+
+logger = logging.getLogger(__name__)
+
+MAX_KEY_LENGTH = 255
+STORED_HEADERS = ["Content-Type", "Location"] # The headers of the original response that a retry gets back
+IDEMPOTENCY_TTL = "24 hours" # How long responses are kept for retries, after which the purge worker removes them (see purge.py)
+IN_FLIGHT_TIMEOUT = "1 minute" # A key whose request hasn't finished after this long is assumed to have been lost with its worker
+
+# Claims the key for this request, unless another request already has it. A key that is still in flight after IN_FLIGHT_TIMEOUT
+# can be claimed by a retry with the same payload, so that a worker dying mid-request doesn't block the key for a day.
+CLAIM_SQL = f"""INSERT INTO idempotency_key (scope, key, fingerprint) VALUES ($1, $2, $3)
+ON CONFLICT (scope, key) DO UPDATE SET created_at = EXCLUDED.created_at
+WHERE idempotency_key.status IS NULL AND idempotency_key.fingerprint = EXCLUDED.fingerprint
+AND idempotency_key.created_at < EXCLUDED.created_at - interval '{IN_FLIGHT_TIMEOUT}'
+RETURNING key;"""
+
+def scope(authorization):
+    """Returns the scope of the current request's key, an HMAC of its Authorization header keyed by IDEMPOTENCY_SECRET. The header
+    holds the user's password, so a plain hash would let anyone who can read the table guess passwords offline. Without the
+    secret, which is never stored in the database, they can't. Returns None if IDEMPOTENCY_SECRET isn't set."""
+    secret = environ.get('IDEMPOTENCY_SECRET')
+    if not secret:
+        return None
+    return hmac.new(secret.encode(), authorization.encode(), sha256).hexdigest()
+
+def fingerprint(body):
+    """Returns a hash of the method, path and body of the current request, so a key reused for a different request can be spotted."""
+    return sha256(f"{request.method} {request.full_path}\n".encode() + body).hexdigest()
+
+def idempotent(f):
+    """A decorator for POST routes that clients retry, which must be placed above auth_needed. If the request has an
+    Idempotency-Key header, the response is stored in the idempotency_key table and a retry with the same key gets the
+    stored response straight away, without the route (or authentication, which hashes the password) running again.
+    Keys are scoped to the Authorization header, so one user can never get another's response. Keys are ignored, with a
+    warning, if IDEMPOTENCY_SECRET isn't set, as the scope can't be stored safely without it. A retry gets a 409 while the
+    first request is still running, and a 422 if the key was used for a different request. Responses that may succeed if
+    retried, 429 and 5xx, are not stored, and neither are 401s, so a request that never authenticated can't leave a response
+    under the key."""
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return await f(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return '', HTTPCode.BADREQUEST
+
+        key_scope = scope(request.headers.get("Authorization", ""))
+        if key_scope is None:
+            logger.warning("Ignoring an Idempotency-Key as IDEMPOTENCY_SECRET isn't set")
+            return await f(*args, **kwargs)
+
+        db = current_app.config['db_handler']
+        hashed = fingerprint(await request.get_data())
+        if not await db.fetchrow(CLAIM_SQL, key_scope, key, hashed, primary = True):
+            stored = await db.fetchrow("SELECT fingerprint, status, body, headers FROM idempotency_key WHERE scope = $1 AND key = $2;", key_scope, key, primary = True)
+            if not stored or stored.get("status") is None:
+                return '', HTTPCode.CONFLICT, {"Retry-After": "1"} # The first request is still running, or has just been released
+            if stored.get("fingerprint") != hashed:
+                return '', HTTPCode.UNPROCESSABLEENTITY
+            return stored.get("body"), stored.get("status"), {**json.loads(stored.get("headers")), "Idempotent-Replayed": "true"}
+
+        try:
+            response = await make_response(await f(*args, **kwargs))
+        except Exception:
+            await release(db, key_scope, key)
+            raise
+        if response.status_code in (HTTPCode.UNAUTHORIZED, HTTPCode.TOOMANYREQUESTS) or response.status_code >= 500:
+            await release(db, key_scope, key)
+        else:
+            headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+            await db.execute("UPDATE idempotency_key SET status = $3, body = $4, headers = $5 WHERE scope = $1 AND key = $2;",
+                key_scope, key, response.status_code, await response.get_data(as_text = True), json.dumps(headers))
+        return response
+    return decorated_function
+
+async def release(db, scope, key):
+    """Removes the claim on a key whose request failed, so that a retry runs the route again."""
+    await db.execute("DELETE FROM idempotency_key WHERE scope = $1 AND key = $2 AND status IS NULL;", scope, key)
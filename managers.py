@@ -1,9 +1,52 @@
 ﻿from quart import current_app
 from auth import hash_func, Auth
-from utils import HTTPCode
+from utils import HTTPCode, academic_year, academic_year_start, ACADEMIC_YEAR_SQL
 from exceptions import UsernameTaken
-from objects import Student, Teacher, Task, Group, Mark, Cache
-from asyncpg import UniqueViolationError
+from objects import Student, Teacher, Task, Group, Mark, Cache, SingleFlight
+from datetime import datetime, timedelta
+from os import environ
+from events import reference
+
+# Deleting a student, teacher or group only sets its deleted_at, and the purge worker (see purge.py) removes it and the rows that
+# depend on it later. These subqueries give the IDs of the rows that are deleted but not yet purged, so that they can be hidden.
+# There are only ever a few of them, which are read from the partial indexes on deleted_at.
+DELETED_STUDENTS = "(SELECT id FROM student WHERE deleted_at IS NOT NULL)"
+DELETED_GROUPS = "(SELECT id FROM group_tbl WHERE deleted_at IS NOT NULL)"
+
+def projection(obj, fields = None, table = None):
+    """Returns the SQL column list for `fields` of the object class `obj`, or every column if `fields` is None. `table` is an optional
+    table name to prefix each column with. The fields must already have been checked against `obj.fields` as they are put into the SQL."""
+    prefix = table + "." if table else ""
+    return ", ".join(prefix + column for column in (fields or obj.fields))
+
+def json_object(obj, fields = None, table = None):
+    """Returns SQL that builds the same JSON object as the __str__ of `obj` from the columns `fields` (every public column if None),
+    with the keys in the same order, a reference object for each _id column and datetimes in the same format."""
+    prefix = table + "." if table else ""
+    pairs = []
+    for field in sorted(fields or obj.public_fields()):
+        column = prefix + field
+        if field.endswith("_id"):
+            name = field.split("_id")[0]
+            pairs.append(f"'{name}', json_build_object('reference', json_build_object('id', {column}, 'link', '/{name}/' || {column}))")
+        elif field in obj.timestamp_fields:
+            # str(datetime) only shows microseconds when there are some
+            pairs.append(f"""'{field}', to_char({column}, 'YYYY-MM-DD HH24:MI:SS') ||
+CASE WHEN date_part('microseconds', {column})::int % 1000000 = 0 THEN '' ELSE to_char({column}, '.US') END""")
+        else:
+            pairs.append(f"'{field}', {column}")
+    return "json_build_object(" + ", ".join(pairs) + ")"
+
+def json_query(obj, sql, fields = None):
+    """Wraps the query `sql`, whose columns are `fields` of `obj`, so that it returns the whole response body {"data": [...]} as
+    one text column, `body`, which is NULL if there are no rows. json_agg keeps the order of the rows given by `sql`."""
+    return f"""SELECT '{{"data":' || json_agg({json_object(obj, fields, "r")}) || '}}' AS body FROM ({sql}) AS r"""
+
+def build(obj, data, fields = None):
+    """Creates a list of `obj` objects from the rows in `data`. Partial objects are made if only some `fields` were selected."""
+    if fields:
+        return [obj.create_partial(x) for x in data]
+    return [obj.create_from(x) for x in data]
 
 class AbstractBaseManager:
     """This is an Abstract Base Class (ABC) that only contians references to the methods that need to be implemented by its children.
@@ -15,6 +58,24 @@ class AbstractBaseManager:
 
     def __init__(self, *args, **kwargs):
         self.db = current_app.config['db_handler']
+        self.authz = current_app.config['authorization_cache']
+        self.in_flight = SingleFlight()
+
+    async def coalesce(self, key, factory):
+        """Runs `factory` (a function returning a coroutine), sharing the result with any identical call, denoted by `key`, that is
+        already in flight. This means that a burst of identical reads only costs one query. The result is shared between callers,
+        so this should only be used for reads whose result isn't edited. Requests that have written are only coalesced with each
+        other, as they read from the primary."""
+        return await self.in_flight.run((key, self.db.pinned), factory)
+
+    async def fetch_list(self, obj, sql, params, fields = None, as_json = False):
+        """Returns the rows of `sql` as a list of `obj` objects. If `as_json` is True, the database builds the JSON response body
+        instead and it is returned as a string (or None if there are no rows), so no objects are made for each row.
+        `fields` are the columns `sql` selects, or None if it selects every public column."""
+        if as_json:
+            data = await self.db.fetchrow(json_query(obj, sql, fields) + ";", *params)
+            return data.get("body")
+        return build(obj, await self.db.fetch(sql + ";", *params), fields)
 
     def create(self, *args, **kwargs):
         pass
@@ -29,24 +90,26 @@ class AbstractBaseManager:
         pass
 
 class AbstractUserManager(AbstractBaseManager):
-    """AbstractUserManager implements, by default, a cache of size 16. `student` is a required boolean denoting if the sub-class is a student or not.
+    """AbstractUserManager implements, by default, a cache of size 16, which can be changed with the USER_CACHE_SIZE environment variable. `student` is a required boolean denoting if the sub-class is a student or not.
+    It also keeps a negative cache of usernames that were recently found not to exist, so repeated lookups of them don't query the database.
     AbstractUserManager and all of its children work assuming that user authentication has been previously handled in the calling subroutines."""
     def __init__(self, student, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.cache = Cache(16)
+        self.cache = Cache(int(environ.get('USER_CACHE_SIZE', 16)))
+        self.unknown_usernames = Cache(1024) # Value is the time the entry expires, as another worker may create the user
+        self.unknown_ttl = timedelta(seconds = 30)
         self.table_name = {True: 'student', False:'teacher'}[student] # This is not susseptible to attack (no user inputs)
         self.child_obj = {True: Student, False: Teacher}[student]
 
-    async def get(self, id = -1, username = ""):
+    async def get(self, id = -1, username = "", fields = None):
         """Gets a user by ID or by Username, if neither are supplied then all users are returned.
-        This method firstly checks the cache before querying the database BUT cache is not checked when getting all students."""
+        This method firstly checks the cache before querying the database BUT cache is not checked when getting all students.
+        When getting all users, only the columns in `fields` are selected, which defaults to every column apart from the password and salt."""
         if id == -1 and username == "":
             # Get all users
-            all = await self.db.fetch(f"SELECT * FROM {self.table_name} ORDER BY id;")
-            to_return = []
-            for user in all:
-                to_return.append(self.child_obj.create_from(user))
-            return to_return
+            fields = fields or self.child_obj.public_fields()
+            all = await self.db.fetch(f"SELECT {projection(self.child_obj, fields)} FROM {self.table_name} WHERE deleted_at IS NULL ORDER BY id;")
+            return build(self.child_obj, all, fields)
 
         if id != -1:
             # Search by ID
@@ -54,30 +117,68 @@ class AbstractUserManager(AbstractBaseManager):
                 if self.cache.c[key].id == id:
                     return self.cache.c[key]
 
-            data = await self.db.fetchrow(f"SELECT * FROM {self.table_name} WHERE id = $1;", id)
-            if not data:
-                return False
-            else:
-                user = self.child_obj.create_from(data)
-                self.cache.add(user.username, user)
-                return user
+            return await self.coalesce(("id", id), lambda: self._fetch_user("id", id))
 
         elif username != "":
             # Search by username
             cached = self.cache.get(username)
             if not cached:
-                data = await self.db.fetchrow(f"SELECT * FROM {self.table_name} WHERE username = $1;", username)
-                if not data:
+                if self.is_username_unknown(username):
                     return False
-                user = self.child_obj.create_from(data)
-                self.cache.add(username, user)
-                return user
+                return await self.coalesce(("username", username), lambda: self._fetch_user("username", username))
             else:
                 return cached
 
+    async def _fetch_user(self, column, value):
+        """Internal method that gets a user from the database where `column` (id or username) is `value`, and adds it to the cache."""
+        data = await self.db.fetchrow(f"SELECT * FROM {self.table_name} WHERE {column} = $1 AND deleted_at IS NULL;", value)
+        if not data:
+            if column == "username":
+                self.unknown_usernames.add(value, datetime.now() + self.unknown_ttl)
+            return False
+        user = self.child_obj.create_from(data)
+        self.cache.add(user.username, user)
+        return user
+
+    async def get_many(self, ids):
+        """Gets many users at once by a list of `ids`. Users in the cache are used straight away and the rest are fetched in
+        one query and added to the cache. Returns a dictionary of the users found, keyed by ID. Users that don't exist are left out."""
+        ids = list(dict.fromkeys(ids))
+        found = {user.id: user for user in self.cache.c.values() if user.id in ids}
+        missing = [id for id in ids if id not in found]
+        if missing:
+            data = await self.db.fetch(f"SELECT * FROM {self.table_name} WHERE id = ANY($1::int[]) AND deleted_at IS NULL;", missing)
+            for row in data:
+                user = self.child_obj.create_from(row)
+                self.cache.add(user.username, user)
+                found[user.id] = user
+        return found
+
+    async def fill_cache(self, sql, *params):
+        """Adds every user returned by `sql` to the cache, and returns them. Used to warm the cache up in bulk."""
+        users = [self.child_obj.create_from(row) for row in await self.db.fetch(sql, *params)]
+        for user in users:
+            self.cache.add(user.username, user)
+        return users
+
+    def is_username_unknown(self, username):
+        """Returns True if `username` was recently found not to exist."""
+        expires = self.unknown_usernames.get(username)
+        if expires and expires > datetime.now():
+            return True
+        return False
+
     async def delete(self, id):
-        """Delete a user object from the database."""
-        await self.db.execute(f"DELETE FROM {self.table_name} WHERE id = $1;", id)
+        """Marks a user as deleted, which hides them straight away. They, and everything that depends on them, are removed
+        from the database in the background by the purge worker."""
+        await self.db.execute(f"UPDATE {self.table_name} SET deleted_at = now() AT TIME ZONE 'utc' WHERE id = $1 AND deleted_at IS NULL;", id)
+        self.forget(id)
+
+    def forget(self, id):
+        """Removes the user with the given `id` from the cache and the authorization cache."""
+        for username in [key for key, user in self.cache.c.items() if user.id == id]:
+            self.cache.remove(username)
+        self.authz.discard(self.table_name, id)
 
     async def is_user_valid(self, username, password):
         """Checks in the DB if the username + password combination exists. This is a function such that multiple routes can use this function.
@@ -95,8 +196,11 @@ class AbstractUserManager(AbstractBaseManager):
                 return False
     
         # ELSE CHECK DB
-        fetched = await self.db.fetchrow(f"SELECT * FROM {self.table_name} WHERE username = $1;", username)
+        if self.is_username_unknown(username):
+            return False # Recently found not to exist, don't query again
+        fetched = await self.db.fetchrow(f"SELECT * FROM {self.table_name} WHERE username = $1 AND deleted_at IS NULL;", username)
         if not fetched:
+            self.unknown_usernames.add(username, datetime.now() + self.unknown_ttl)
             return False # No user found with that username
     
         # CHECK HASHES
@@ -112,7 +216,8 @@ class AbstractUserManager(AbstractBaseManager):
             return False
 
     async def is_username_taken(self, username):
-        """Returns True if the username is taken, and False if the username is not already taken."""
+        """Returns True if the username is taken, and False if the username is not already taken. The username of a deleted
+        user is taken until they are purged, as the unique index on username still includes them."""
         data = await self.db.fetchrow(f"SELECT EXISTS (SELECT username FROM {self.table_name} WHERE username = $1);", username)
         return data.get("exists")
 
@@ -129,6 +234,20 @@ class StudentManager(AbstractUserManager):
     def __init__(self, *args, **kwargs):
         super().__init__(True, *args, **kwargs)
 
+    async def warm_up(self):
+        """Fills the cache with up to USER_CACHE_SIZE recently active students, i.e. those in a group with a task due in the last
+        week or in the future, and caches the groups each of them is in for permission checks."""
+        students = await self.fill_cache(f"""SELECT * FROM student WHERE password IS NOT NULL AND deleted_at IS NULL AND id IN
+(SELECT student_group.student_id FROM student_group
+INNER JOIN task ON task.group_id = student_group.group_id
+WHERE task.date_due > now() - interval '7 days' AND task.group_id NOT IN {DELETED_GROUPS})
+LIMIT $1;""", self.cache.limit)
+        data = await self.db.fetch(f"""SELECT student_id, array_agg(group_id) AS groups FROM student_group
+WHERE student_id = ANY($1::int[]) AND group_id NOT IN {DELETED_GROUPS} GROUP BY student_id;""", [student.id for student in students])
+        for row in data:
+            self.authz.set("student", row.get("student_id"), set(row.get("groups")))
+        return len(students)
+
     async def is_student_valid(self, username, password):
         """An alias function for AbstractUserManager.is_user_valid."""
         return await self.is_user_valid(username, password)
@@ -145,6 +264,7 @@ class StudentManager(AbstractUserManager):
             salt, hashed = await hash_func(password) # Function that hashes a password
 
         await self.db.execute("INSERT INTO student (forename, surname, username, alps, password, salt) VALUES ($1, $2, $3, $4, $5, $6);", forename, surname, username, alps, hashed, salt)
+        self.unknown_usernames.remove(username)
 
     async def update(self, current_student: Student, student: Student, reset_password = False, new_password = ''):
         """Updates a student object. This takes in 2 required args and 2 optional.
@@ -158,6 +278,7 @@ class StudentManager(AbstractUserManager):
             raise UsernameTaken
         
         self.cache.remove(current_student.username) # Remove from cache
+        self.unknown_usernames.remove(student.username)
 
         if reset_password: # Set password to None
             await self.db.execute("UPDATE student SET forename = $1, surname = $2, username = $3, alps = $4, password = $5, salt = $6 WHERE id = $7;", student.forename, student.surname, student.username, student.alps, None, None, student.id)
@@ -172,6 +293,18 @@ class TeacherManager(AbstractUserManager):
     def __init__(self, *args, **kwargs):
         super().__init__(False, *args, **kwargs)
 
+    async def warm_up(self):
+        """Fills the cache with teachers, up to USER_CACHE_SIZE of them. Set USER_CACHE_SIZE to at least the number of teachers for them all to fit."""
+        return len(await self.fill_cache("SELECT * FROM teacher WHERE deleted_at IS NULL ORDER BY id LIMIT $1;", self.cache.limit))
+
+    async def delete(self, id):
+        """Marks a teacher and all of their groups as deleted, see AbstractUserManager.delete."""
+        data = await self.db.fetch("""WITH teacher_deleted AS (UPDATE teacher SET deleted_at = now() AT TIME ZONE 'utc' WHERE id = $1 AND deleted_at IS NULL)
+UPDATE group_tbl SET deleted_at = now() AT TIME ZONE 'utc' WHERE teacher_id = $1 AND deleted_at IS NULL RETURNING id;""", id, primary = True)
+        self.forget(id)
+        for row in data:
+            self.authz.forget_group(row.get("id"))
+
     async def is_teacher_valid(self, username, password):
         """An alias function for AbstractUserManager.is_user_valid."""
         return await self.is_user_valid(username, password)
@@ -188,6 +321,7 @@ class TeacherManager(AbstractUserManager):
         
         salt, hashed = await hash_func(password)
         await self.db.execute("INSERT INTO teacher (forename, surname, username, title, password, salt) VALUES ($1, $2, $3, $4, $5, $6);", forename, surname, username, title, hashed, salt)
+        self.unknown_usernames.remove(username)
 
     async def update(self, current_teacher: Teacher, teacher: Teacher, new_password = ''):
         """Procedure that updates a given teacher. Takes in a current_teacher, updated_teacher and an optional new_password."""
@@ -197,6 +331,7 @@ class TeacherManager(AbstractUserManager):
             raise UsernameTaken
         
         self.cache.remove(current_teacher.username)
+        self.unknown_usernames.remove(teacher.username)
 
         if new_password == '':
             # Keeping current password
@@ -209,124 +344,245 @@ class TeacherManager(AbstractUserManager):
 class GroupManager(AbstractBaseManager):
     """Manager that controls the database when processing groups."""
 
-    async def get(self, group_id = -1, student_id = -1, teacher_id = -1):
-        """Gets all groups from the database. If the GroupID is not provided then it will return all groups."""
+    async def get(self, group_id = -1, student_id = -1, teacher_id = -1, fields = None):
+        """Gets all groups from the database. If the GroupID is not provided then it will return all groups.
+        When getting a list of groups, only the columns in `fields` are selected if it is given.
+        Identical concurrent requests for lists of groups are coalesced into one query."""
+        if group_id != -1:
+            return await self._get(group_id = group_id) # A single group may be edited by the caller so it is never shared
+        return await self.coalesce(("get", student_id, teacher_id, tuple(fields or ())), lambda: self._get(student_id = student_id, teacher_id = teacher_id, fields = fields))
+
+    async def _get(self, group_id = -1, student_id = -1, teacher_id = -1, fields = None):
+        """Internal method that gets groups from the database, see GroupManager.get."""
+        columns = projection(Group, fields, "group_tbl")
         if student_id != -1:
             # Get students groups
-            data = await self.db.fetch("""SELECT group_tbl.id, group_tbl.teacher_id, group_tbl.name, group_tbl.subject
+            data = await self.db.fetch(f"""SELECT {columns}
 FROM student_group
 INNER JOIN group_tbl ON student_group.group_id = group_tbl.id
-WHERE student_group.student_id = $1;""", student_id)
-            return [Group.create_from(x) for x in data] if data else False
+WHERE student_group.student_id = $1 AND group_tbl.deleted_at IS NULL;""", student_id)
+            return build(Group, data, fields) if data else False
 
         if teacher_id != -1:
             # Get teachers groups
-            data = await self.db.fetch("SELECT * FROM group_tbl WHERE teacher_id = $1;", teacher_id)
-            return [Group.create_from(x) for x in data] if data else False
+            data = await self.db.fetch(f"SELECT {columns} FROM group_tbl WHERE teacher_id = $1 AND deleted_at IS NULL;", teacher_id)
+            return build(Group, data, fields) if data else False
 
         if group_id == -1:
             # Get all groups
-            to_return = []
-            data = await self.db.fetch("SELECT * FROM group_tbl;")
+            data = await self.db.fetch(f"SELECT {columns} FROM group_tbl WHERE deleted_at IS NULL;")
             if not data:
                 return False
-            for group in data:
-                to_return.append(Group.create_from(group))
-            return to_return
+            return build(Group, data, fields)
         else:
             if group_id < 1:
                 return None
-            group = await self.db.fetchrow("SELECT * FROM group_tbl WHERE id = $1;", group_id)
+            group = await self.db.fetchrow("SELECT * FROM group_tbl WHERE id = $1 AND deleted_at IS NULL;", group_id)
             if not group:
                 return False
             return Group.create_from(group)
 
+    async def warm_up(self):
+        """Groups are not cached in the process, so this caches the groups each teacher owns for permission checks, for up to
+        as many teachers as the permission cache holds."""
+        data = await self.db.fetch("""SELECT teacher_id, array_agg(id) AS groups FROM group_tbl WHERE deleted_at IS NULL
+GROUP BY teacher_id LIMIT $1;""", self.authz.limit)
+        for row in data:
+            self.authz.set("teacher", row.get("teacher_id"), set(row.get("groups")))
+        return sum(len(row.get("groups")) for row in data)
+
     async def create(self, teacher_id, name, subject):
-        """Creates a group from data given."""
-        await self.db.execute("INSERT INTO group_tbl (teacher_id, name, subject) VALUES ($1, $2, $3);", teacher_id, name, subject)
+        """Creates a group from data given. Returns the ID of the new group."""
+        data = await self.db.fetchrow("INSERT INTO group_tbl (teacher_id, name, subject) VALUES ($1, $2, $3) RETURNING id;", teacher_id, name, subject, primary = True)
+        group_id = data.get("id")
+        self.authz.add_group("teacher", teacher_id, group_id)
+        return group_id
     
     async def delete(self, group_id):
-        """Deletes a group from the database using the group_id given."""
-        await self.db.execute("DELETE FROM group_tbl WHERE id = $1;", group_id)
+        """Marks a group as deleted using the group_id given, which hides it and its tasks straight away. The group, its tasks
+        and their marks are removed from the database in the background by the purge worker."""
+        await self.db.execute("UPDATE group_tbl SET deleted_at = now() AT TIME ZONE 'utc' WHERE id = $1 AND deleted_at IS NULL;", group_id)
+        self.authz.forget_group(group_id)
 
     async def update(self, group: Group):
         """Updates a group given by `group`. The group edited is the `group.id` and its new values are also stored in `group`."""
         await self.db.execute("UPDATE group_tbl SET teacher_id = $1, subject = $2, name = $3 WHERE id = $4;", group.teacher_id, group.subject, group.name, group.id)
-
-    async def add_student(self, student_id, group_id):
-        """Method that adds a student, `student_id`, to the group, `group_id` using the StudentGroupJoin table."""
-        try:
-            await self.db.execute("INSERT INTO student_group (student_id, group_id) VALUES ($1, $2);", student_id, group_id)
-        except UniqueViolationError: # Key already exists, do not worry
-            pass
-
-    async def remove_student(self, student_id, group_id):
-        """Method that removes a student, `student_id`, to the group, `group_id` using the StudentGroupJoin table."""
-        await self.db.execute("DELETE FROM student_group WHERE student_id = $1 and group_id = $2;", student_id, group_id)
-
-    async def students(self, group_id):
-        """Returns all the students in a given group, denoted by `group_id`."""
-        data = await self.db.fetch("""SELECT id, forename, surname, username, salt, password, alps
+        self.authz.move_group(group.id, group.teacher_id) # The group may have been given to another teacher
+
+    async def add_students(self, student_ids, group_id):
+        """Method that adds every student in the list `student_ids` to the group, `group_id`, in one query. Students already in the group are skipped."""
+        await self.db.execute("INSERT INTO student_group (student_id, group_id) SELECT unnest($1::int[]), $2 ON CONFLICT DO NOTHING;", student_ids, group_id)
+        for student_id in student_ids:
+            self.authz.add_group("student", student_id, group_id)
+
+    async def remove_students(self, student_ids, group_id):
+        """Method that removes every student in the list `student_ids` from the group, `group_id`, in one query."""
+        await self.db.execute("DELETE FROM student_group WHERE student_id = ANY($1::int[]) and group_id = $2;", student_ids, group_id)
+        for student_id in student_ids:
+            self.authz.remove_group("student", student_id, group_id)
+
+    async def students(self, group_id, fields = None):
+        """Returns all the students in a given group, denoted by `group_id`. Only the columns in `fields` are selected,
+        which defaults to every column apart from the password and salt."""
+        fields = fields or Student.public_fields()
+        data = await self.db.fetch(f"""SELECT {projection(Student, fields, "student")}
         FROM student_group
-        LEFT JOIN student ON student.id = student_group.student_id
-        WHERE student_group.group_id = $1;""", group_id) # Get student data from the join table
-        return [Student.create_from(x) for x in data] # Return student objects
+        INNER JOIN student ON student.id = student_group.student_id
+        WHERE student_group.group_id = $1 AND student.deleted_at IS NULL;""", group_id) # Get student data from the join table
+        return build(Student, data, fields) # Return student objects
 
 class TaskManager(AbstractBaseManager):
+    """Manager that controls the database when processing tasks. Setting or changing a task, and giving feedback, publishes an event
+    through the event broker so that connected clients know to fetch again."""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.events = current_app.config['event_broker']
+        self.completions = current_app.config.get('completion_queue') # None unless write-behind is enabled
 
     async def _mark_exists(self, student_id, task_id):
         """Internal method used to see if a mark already exists in the table."""
         query_result = await self.db.fetchrow("SELECT EXISTS (SELECT * FROM mark_tbl WHERE student_id = $1 AND task_id = $2);", student_id, task_id)
         return query_result.get("exists")
 
-    async def get(self, id = -1, student_id = -1, group_id = -1, teacher_id = -1, get_completed = False):
+    async def get(self, id = -1, student_id = -1, group_id = -1, teacher_id = -1, get_completed = False, fields = None,
+            due_before = None, due_after = None, completed = None, sort = None, limit = None, year = None, as_json = False):
         """Function that returns the tasks. It can take a task id, student id, or a group id as arguments.
         If no task is found -> False
-        If no arguments are given -> all tasks are returned"""
-        
-        if id == -1 and student_id == -1 and group_id == -1 and teacher_id == -1: # Then no parameters have been given
-            # Get all tasks
-            data = await self.db.fetch("SELECT * FROM task;")
-            return [Task.create_from(x) for x in data]
-        
+        If no arguments are given -> all tasks are returned
+        When getting a list of tasks, only the columns in `fields` are selected if it is given. `has_completed` may only be
+        in `fields` if `get_completed` is True.
+        Lists of tasks can also be filtered and sorted in the query:
+        due_before / due_after: only tasks due before / after the given datetime
+        completed: only tasks the student has (True) or hasn't (False) completed, only valid with `student_id`
+        sort: a tuple of (field, descending) to sort by
+        limit: the maximum number of tasks to return
+        year: the academic year to get tasks from, which are read from the archive if it is a past year
+        If `as_json` is True a list of tasks is returned as the JSON response body built by the database, see fetch_list.
+        Identical concurrent requests for lists of tasks are coalesced into one query."""
+        if id != -1:
+            return await self._get(id = id) # A single task may be edited by the caller so it is never shared
+        query = dict(student_id = student_id, group_id = group_id, teacher_id = teacher_id, get_completed = get_completed, fields = fields,
+            due_before = due_before, due_after = due_after, completed = completed, sort = sort, limit = limit, year = year, as_json = as_json)
+        return await self.coalesce(("get", tuple((key, tuple(value) if type(value) == list else value) for key, value in query.items())), lambda: self._get(**query))
+
+    async def _get(self, id = -1, student_id = -1, group_id = -1, teacher_id = -1, get_completed = False, fields = None,
+            due_before = None, due_after = None, completed = None, sort = None, limit = None, year = None, as_json = False):
+        """Internal method that builds the query for and gets tasks from the database, see TaskManager.get."""
         if id != -1:
             # Search for the specific task
-            data = await self.db.fetchrow("SELECT * FROM task WHERE id = $1;", int(id))
-            return Task.create_from(data) #TODO: Error checking - if not data, id < 1, etc.
-
-        if student_id != -1:
-            # Get all the tasks the student can see
-            if get_completed:
-                data = await self.db.fetch("""WITH t as (SELECT * FROM task WHERE group_id IN (SELECT group_id FROM student_group WHERE student_id = $1)),
-m as (SELECT task_id, has_completed FROM mark_tbl WHERE student_id = $1)
-SELECT t.id, group_id, title, description, date_set, date_due, max_score,
-(CASE WHEN m.has_completed IS null then false else m.has_completed END)
-FROM t LEFT JOIN m ON t.id = m.task_id;""", int(student_id))
-            else:
-                data = await self.db.fetch("SELECT * FROM task WHERE group_id IN (SELECT group_id FROM student_group WHERE student_id = $1);", int(student_id))
-            return [Task.create_from(x) for x in data]
-
-        if group_id != -1:
-            # Get all the tasks a group can see
-            data = await self.db.fetch("SELECT * FROM task WHERE group_id = $1;", int(group_id))
-            return [Task.create_from(x) for x in data]
-
-        if teacher_id != -1:
-            # Get all the tasks that a teacher has control of - get all tasks for every group the teacher is assigned
-            data = await self.db.fetch("""WITH t AS (SELECT id FROM group_tbl WHERE teacher_id = $1)
-SELECT * FROM task INNER JOIN t ON task.group_id = t.id;""", int(teacher_id))
-            return [Task.create_from(x) for x in data]
+            data = await self.db.fetchrow(f"SELECT * FROM task WHERE id = $1 AND group_id NOT IN {DELETED_GROUPS};", int(id))
+            return Task.create_from(data) if data else False # e.g. deleted, archived or in a deleted group
+
+        params = []
+        def param(value):
+            """Adds `value` to the query's parameters and returns its placeholder."""
+            params.append(value)
+            return "$" + str(len(params))
+
+        with_clause, conditions = "", []
+        selected = fields # The columns selected, None meaning all of Task.fields
+        task_table, mark_table, in_year = "task", "mark_tbl", "" # The hot tables only hold the current academic year
+        archived = year is not None and year < academic_year()
+        if archived:
+            # Past years are read from the archive, where the condition on academic_year means only that year's partition is scanned
+            year = param(int(year))
+            task_table, mark_table, in_year = "task_archive", "mark_archive", f" AND academic_year = {year}"
+        if student_id != -1 and (get_completed or completed is not None):
+            # Get all the tasks the student can see along with whether they have completed them
+            table = "t"
+            student = param(int(student_id))
+            with_clause = f"""WITH t as (SELECT * FROM {task_table} WHERE group_id IN (SELECT group_id FROM student_group WHERE student_id = {student}) AND group_id NOT IN {DELETED_GROUPS}{in_year}),
+m as (SELECT task_id, has_completed FROM {mark_table} WHERE student_id = {student}{in_year})
+"""
+            source = "t LEFT JOIN m ON t.id = m.task_id"
+            has_completed = "(CASE WHEN m.has_completed IS null then false else m.has_completed END)"
+            task_fields = [field for field in (fields or Task.fields) if field != "has_completed"]
+            columns = [projection(Task, task_fields, "t")] if task_fields else []
+            if get_completed and (not fields or "has_completed" in fields):
+                columns.append(has_completed + " AS has_completed")
+                if not fields:
+                    selected = Task.public_fields() + ["has_completed"]
+            columns = ", ".join(columns)
+            if completed is not None:
+                conditions.append(f"{has_completed} = {param(completed)}")
+        else:
+            table = "task"
+            source = "task" if task_table == "task" else f"{task_table} AS task"
+            columns = projection(Task, fields, "task")
+            if archived:
+                conditions.append(f"task.academic_year = {year}")
+            conditions.append(f"task.group_id NOT IN {DELETED_GROUPS}")
+            if student_id != -1:
+                # Get all the tasks the student can see
+                conditions.append(f"task.group_id IN (SELECT group_id FROM student_group WHERE student_id = {param(int(student_id))})")
+            elif group_id != -1:
+                # Get all the tasks a group can see
+                conditions.append(f"task.group_id = {param(int(group_id))}")
+            elif teacher_id != -1:
+                # Get all the tasks that a teacher has control of - get all tasks for every group the teacher is assigned
+                conditions.append(f"task.group_id IN (SELECT id FROM group_tbl WHERE teacher_id = {param(int(teacher_id))})")
+
+        if due_before:
+            conditions.append(f"{table}.date_due < {param(due_before)}")
+        if due_after:
+            conditions.append(f"{table}.date_due > {param(due_after)}")
+
+        sql = f"{with_clause}SELECT {columns}\nFROM {source}"
+        if conditions:
+            sql += "\nWHERE " + " AND ".join(conditions)
+        if sort:
+            column, descending = sort
+            if column not in Task.fields:
+                raise ValueError # Only checked fields can be put into the SQL
+            sql += f"\nORDER BY {table}.{column} {'DESC' if descending else 'ASC'}, {table}.id" # The ID makes the order of ties stable
+        if limit:
+            sql += f"\nLIMIT {param(int(limit))}"
+
+        if as_json:
+            return await self.fetch_list(Task, sql, params, selected, as_json = True)
+        return await self.fetch_list(Task, sql, params, fields)
+
+    async def warm_up(self):
+        """Caches the group of each current task (due in the last week or in the future) for permission checks, soonest due
+        first, up to the size of the permission cache."""
+        data = await self.db.fetch(f"""SELECT id, group_id FROM task WHERE date_due > now() - interval '7 days' AND group_id NOT IN {DELETED_GROUPS}
+ORDER BY date_due LIMIT $1;""", self.authz.limit)
+        for row in data:
+            self.authz.set("task", row.get("id"), row.get("group_id"))
+        return len(data)
 
     async def create(self, group_id, title, desc, date_due, max_score):
-        """Creates a new task in the database."""
-        await self.db.execute("INSERT INTO task (title, description, group_id, max_score, date_due) VALUES ($1, $2, $3, $4, $5);", title, desc, group_id, max_score, date_due)
+        """Creates a new task in the database. Returns the ID of the new task."""
+        data = await self.db.fetchrow("INSERT INTO task (title, description, group_id, max_score, date_due) VALUES ($1, $2, $3, $4, $5) RETURNING id;", title, desc, group_id, max_score, date_due, primary = True)
+        task_id = data.get("id")
+        self.authz.set("task", task_id, group_id)
+        await self.events.publish(("group", group_id), {"type": "task_created", "task": reference("task", task_id), "group": reference("group", group_id)})
+        return task_id
+
+    async def create_many(self, group_ids, title, desc, date_due, max_score, teacher_id):
+        """Creates the same task for every group in `group_ids`, all of which must be owned by the teacher `teacher_id`, else
+        PermissionError is raised. The ownership check and the insert are one query each. Returns a dictionary of group ID -> new task ID."""
+        group_ids = list(dict.fromkeys(group_ids))
+        owned = await self.db.fetch("SELECT id FROM group_tbl WHERE id = ANY($1::int[]) AND teacher_id = $2 AND deleted_at IS NULL;", group_ids, teacher_id)
+        if len(owned) != len(group_ids):
+            raise PermissionError # Includes groups that don't exist
+
+        data = await self.db.fetch("""INSERT INTO task (title, description, group_id, max_score, date_due)
+SELECT $1, $2, g.group_id, $3, $4 FROM unnest($5::int[]) AS g(group_id)
+RETURNING id, group_id;""", title, desc, max_score, date_due, group_ids, primary = True)
+        created = {row.get("group_id"): row.get("id") for row in data}
+        for group_id, task_id in created.items():
+            self.authz.set("task", task_id, group_id)
+        await self.events.publish_many([(("group", group_id), {"type": "task_created", "task": reference("task", task_id), "group": reference("group", group_id)})
+            for group_id, task_id in created.items()])
+        return created
 
     async def update(self, task: Task):
         """Updates an existing task given by `task`. The task is edited by looking at `task.id`."""
         params = [task.title, task.description, task.group_id, task.max_score, task.date_set, task.date_due, task.id]
         await self.db.execute("UPDATE task SET title = $1, description = $2, group_id = $3, max_score = $4, date_set = $5, date_due = $6 WHERE id = $7;", *params)
+        self.authz.set("task", task.id, task.group_id)
+        await self.events.publish(("group", task.group_id), {"type": "task_updated", "task": reference("task", task.id), "group": reference("group", task.group_id)})
 
     async def delete(self, task_id):
         """Deletes the a task from the database, given the ID of the task."""
@@ -335,18 +591,63 @@ SELECT * FROM task INNER JOIN t ON task.group_id = t.id;""", int(teacher_id))
             return False # TODO: Perhaps change this to an exception - make all validation errors throw exceptions which can be handled in the main program too
         else:
             await self.db.execute("DELETE FROM task WHERE id = $1;", task_id)
+            self.authz.discard("task", task_id)
+
+    async def task_group_id(self, task_id):
+        """Returns the ID of the group the task is set for, or None if the task doesn't exist. Uses the authorization cache."""
+        group_id = self.authz.get("task", task_id)
+        if group_id is None:
+            data = await self.db.fetchrow(f"SELECT group_id FROM task WHERE id = $1 AND group_id NOT IN {DELETED_GROUPS};", task_id)
+            if not data:
+                return None
+            group_id = data.get("group_id")
+            self.authz.set("task", task_id, group_id)
+        return group_id
+
+    async def user_group_ids(self, kind, user_id, refresh = False):
+        """Returns the set of IDs of the groups a student is in (`kind` is "student") or a teacher owns (`kind` is "teacher").
+        Uses the authorization cache unless `refresh` is True."""
+        groups = None if refresh else self.authz.get(kind, user_id)
+        if groups is None:
+            if kind == "student":
+                data = await self.db.fetch(f"SELECT group_id FROM student_group WHERE student_id = $1 AND group_id NOT IN {DELETED_GROUPS};", user_id)
+            else:
+                data = await self.db.fetch("SELECT id AS group_id FROM group_tbl WHERE teacher_id = $1 AND deleted_at IS NULL;", user_id)
+            groups = {row.get("group_id") for row in data}
+            self.authz.set(kind, user_id, groups)
+        return groups
+
+    async def _in_group(self, kind, user_id, task_id):
+        """Internal method that returns True if the task is set for one of the groups of the student or teacher. The cached facts
+        are trusted when they allow access. As another worker may have changed them, a denial is checked again against the database."""
+        group_id = await self.task_group_id(task_id)
+        if group_id is None:
+            return False
+        if group_id in await self.user_group_ids(kind, user_id):
+            return True
+        self.authz.discard("task", task_id)
+        group_id = await self.task_group_id(task_id)
+        return group_id is not None and group_id in await self.user_group_ids(kind, user_id, refresh = True)
+
+    async def can_student_access(self, student_id, task_id):
+        """Returns True if the task is set for one of the student's groups."""
+        return await self._in_group("student", student_id, task_id)
+
+    async def does_teacher_own(self, teacher_id, task_id):
+        """Returns True if the task is set for one of the teacher's groups."""
+        return await self._in_group("teacher", teacher_id, task_id)
 
     async def student_completed(self, has_completed:bool, student_id, task_id):
         """Either adds a new reference to the task+student in the mark_tbl table or edits an existing one. This method
-        changes their completed variable to `completed` provided."""
-
-        query = await self.db.fetchrow("""SELECT EXISTS
-(SELECT * FROM task WHERE group_id IN
-(SELECT group_id FROM student_group WHERE student_id = $1)
-AND task.id = $2);""", student_id, task_id)
-        if not query.get("exists"):
+        changes their completed variable to `completed` provided. If write-behind is enabled the write is queued
+        after the permission check, and is written to the database within the write-behind window."""
+        if not await self.can_student_access(student_id, task_id):
             raise PermissionError
 
+        if self.completions:
+            self.completions.submit(student_id, task_id, has_completed)
+            return
+
         if await self._mark_exists(student_id, task_id):
             # Student exists, update current
             await self.db.execute("UPDATE mark_tbl SET has_completed = $1 WHERE student_id = $2 AND task_id = $3;", has_completed, student_id, task_id)
@@ -359,48 +660,117 @@ AND task.id = $2);""", student_id, task_id)
         has already been completed. `auth_obj` is necessary to ensure that only the correct teacher is giving
         the feedback."""
 
-        query = await self.db.fetchrow("""SELECT EXISTS
-(SELECT teacher_id FROM group_tbl WHERE group_tbl.id =
-(SELECT group_id FROM task WHERE task.id = $1)
-AND teacher_id = $2);""", task_id, auth_obj.id) #SQL that returns True if the auth_obj.id == task_id.group.teacher.id
-        perms = query.get("exists")
-        if not perms:
+        if not await self.does_teacher_own(auth_obj.id, task_id):
             raise PermissionError
 
         if await self._mark_exists(student_id, task_id):
             await self.db.execute("UPDATE mark_tbl SET feedback = $1, score = $2, has_completed = True, has_marked = True WHERE student_id = $3 AND task_id = $4;", feedback, score, student_id, task_id)
         else:
             await self.db.execute("INSERT INTO mark_tbl (student_id, task_id, feedback, score, has_completed, has_marked) VALUES ($1, $2, $3, $4, True, True);", student_id, task_id, feedback, score)
+        await self.events.publish(("student", student_id), {"type": "feedback", "task": reference("task", task_id)})
+
+    async def provide_feedback_bulk(self, task_id: int, marks, auth_obj):
+        """Provides feedback for many students at once for a given task. `marks` is a list of (student_id, score, feedback).
+        The teacher's ownership of the task is checked once, raising PermissionError if they don't own it, and LookupError is
+        raised if the task doesn't exist. Every mark with a score between 0 and the task's max_score, for a student in the task's group,
+        is written in one statement. Returns a list with the HTTPCode of each mark, in the same order as `marks`. If a student is
+        given more than once, the last mark for them is the one written."""
+        task = await self.db.fetchrow(f"SELECT group_id, max_score FROM task WHERE id = $1 AND group_id NOT IN {DELETED_GROUPS};", task_id)
+        if not task:
+            raise LookupError
+        if not await self.does_teacher_own(auth_obj.id, task_id):
+            raise PermissionError
+
+        student_ids = list({student_id for student_id, _, _ in marks})
+        data = await self.db.fetch(f"SELECT student_id FROM student_group WHERE group_id = $1 AND student_id = ANY($2::int[]) AND student_id NOT IN {DELETED_STUDENTS};", task.get("group_id"), student_ids)
+        members = {row.get("student_id") for row in data}
+
+        results = []
+        valid = {} # Key is student_id, value is (score, feedback)
+        for student_id, score, feedback in marks:
+            if student_id not in members:
+                results.append(HTTPCode.NOTFOUND) # Not in the task's group
+            elif not 0 <= score <= task.get("max_score"):
+                results.append(HTTPCode.BADREQUEST)
+            else:
+                results.append(HTTPCode.OK)
+                valid[student_id] = (score, feedback)
+
+        if valid:
+            await self.db.execute("""INSERT INTO mark_tbl (student_id, task_id, score, feedback, has_completed, has_marked)
+SELECT m.student_id, $1, m.score, m.feedback, True, True FROM UNNEST($2::int[], $3::int[], $4::text[]) AS m(student_id, score, feedback)
+ON CONFLICT (student_id, task_id) DO UPDATE SET score = EXCLUDED.score, feedback = EXCLUDED.feedback, has_completed = True, has_marked = True;""",
+                task_id, list(valid), [score for score, _ in valid.values()], [feedback for _, feedback in valid.values()])
+            await self.events.publish_many([(("student", student_id), {"type": "feedback", "task": reference("task", task_id)}) for student_id in valid])
+        return results
 
 class MarkManager(AbstractBaseManager):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    async def get(self, mark_id = None, student_id = None, group_id = None, task_id = None):
+    async def get(self, mark_id = None, student_id = None, group_id = None, task_id = None, fields = None, year = None, as_json = False):
         """Function that returns marks. It can take a mark id, student id, group id, or task id as an argument.
         If no mark is found -> None
-        If no arguments are given -> all marks are returned"""
+        If no arguments are given -> all marks are returned
+        When getting a list of marks, only the columns in `fields` are selected if it is given.
+        If `year` is a past academic year, the list of marks is read from that year's archive instead.
+        If `as_json` is True a list of marks is returned as the JSON response body built by the database, see fetch_list."""
+        columns = projection(Mark, fields)
+        mark_table, task_table, in_year, params = "mark_tbl", "task", "", []
+        if year is not None and year < academic_year():
+            mark_table, task_table, in_year, params = "mark_archive", "task_archive", " AND academic_year = $2", [int(year)]
+        # Hides the marks of deleted students and of the tasks of deleted groups
+        live = f"student_id NOT IN {DELETED_STUDENTS} AND task_id NOT IN (SELECT id FROM {task_table} WHERE group_id IN {DELETED_GROUPS})"
+
         if not mark_id and not student_id and not group_id and not task_id:
             # No parameters given, return all marks
-            data = await self.db.fetch("SELECT * FROM mark_tbl;")
-            return [Mark.create_from(x) for x in data]
+            return await self.fetch_list(Mark, f"SELECT {columns} FROM {mark_table} WHERE {live}{' AND academic_year = $1' if params else ''}", params, fields, as_json)
 
         if student_id and task_id:
-            data = await self.db.fetchrow("SELECT * FROM mark_tbl WHERE student_id = $1 AND task_id = $2;", student_id, task_id)
+            data = await self.db.fetchrow(f"SELECT * FROM mark_tbl WHERE student_id = $1 AND task_id = $2 AND {live};", student_id, task_id)
             return Mark.create_from(data) if data else None
 
         if task_id:
-            data = await self.db.fetch("SELECT * FROM mark_tbl WHERE task_id = $1;", task_id)
-            return [Mark.create_from(x) for x in data]
+            return await self.fetch_list(Mark, f"SELECT {columns} FROM {mark_table} WHERE task_id = $1 AND {live}{in_year}", [task_id] + params, fields, as_json)
 
         if mark_id:
-            data = await self.db.fetch("SELECT * FROM mark_tbl WHERE id = $1;", mark_id)
-            return [Mark.create_from(x) for x in data]
+            return await self.fetch_list(Mark, f"SELECT {columns} FROM {mark_table} WHERE id = $1 AND {live}{in_year}", [mark_id] + params, fields, as_json)
 
         if student_id:
-            data = await self.db.fetch("SELECT * FROM mark_tbl WHERE student_id = $1;", student_id)
-            return [Mark.create_from(x) for x in data]
+            return await self.fetch_list(Mark, f"SELECT {columns} FROM {mark_table} WHERE student_id = $1 AND {live}{in_year}", [student_id] + params, fields, as_json)
 
         if group_id:
-            data = await self.db.fetch("SELECT * FROM mark_tbl WHERE task_id IN (SELECT id FROM task WHERE group_id = $1);", group_id) # SQL to get all marks for a given group
-            return [Mark.create_from(x) for x in data]
\ No newline at end of file
+            # SQL to get all marks for a given group
+            return await self.fetch_list(Mark, f"SELECT {columns} FROM {mark_table} WHERE task_id IN (SELECT id FROM {task_table} WHERE group_id = $1{in_year}) AND {live}{in_year}", [group_id] + params, fields, as_json)
+
+class ArchiveManager(AbstractBaseManager):
+    """Manager that moves the tasks and marks of past academic years out of the task and mark_tbl tables, into task_archive and
+    mark_archive. Those are partitioned by academic year, so the hot tables and their indexes only hold the current year however
+    many years are kept, and a query for a past year only reads that year's partition."""
+
+    async def create_partitions(self, year):
+        """Creates the archive partitions for the academic year `year` if they don't exist."""
+        year = int(year) # Put into the SQL, so must be an integer
+        await self.db.execute(f"""CREATE TABLE IF NOT EXISTS task_archive_{year} PARTITION OF task_archive FOR VALUES IN ({year});
+CREATE TABLE IF NOT EXISTS mark_archive_{year} PARTITION OF mark_archive FOR VALUES IN ({year});""")
+
+    async def archive(self):
+        """Moves every task set before the current academic year, and their marks, into the archive. The move is one statement
+        so a task is never in both places or neither. Returns a dictionary of the number of tasks and marks archived."""
+        cutoff = academic_year_start(academic_year())
+        data = await self.db.fetch(f"SELECT DISTINCT {ACADEMIC_YEAR_SQL.format('date_set')} AS year FROM task WHERE date_set < $1;", cutoff, primary = True)
+        for row in data:
+            await self.create_partitions(row.get("year"))
+
+        data = await self.db.fetchrow(f"""WITH moved_tasks AS (DELETE FROM task WHERE date_set < $1 RETURNING *),
+moved_marks AS (DELETE FROM mark_tbl WHERE task_id IN (SELECT id FROM moved_tasks) RETURNING *),
+archived_tasks AS (INSERT INTO task_archive ({projection(Task)}, academic_year)
+    SELECT {projection(Task)}, {ACADEMIC_YEAR_SQL.format('date_set')} FROM moved_tasks RETURNING id),
+archived_marks AS (INSERT INTO mark_archive ({projection(Mark)}, id, academic_year)
+    SELECT {projection(Mark, table = 'm')}, m.id, {ACADEMIC_YEAR_SQL.format('t.date_set')} FROM moved_marks m INNER JOIN moved_tasks t ON t.id = m.task_id RETURNING id)
+SELECT (SELECT array_agg(id) FROM archived_tasks) AS task_ids, (SELECT COUNT(*) FROM archived_marks) AS marks;""", cutoff, primary = True)
+
+        task_ids = data.get("task_ids") or []
+        for task_id in task_ids:
+            self.authz.discard("task", task_id) # Archived tasks can't be completed or marked any more
+        return {"tasks": len(task_ids), "marks": data.get("marks")}
@@ -1,7 +1,8 @@
 from quart import Blueprint, request, current_app
-from utils import stringify
+from utils import stringify_list, parse_fields, parse_year
 from utils import HTTPCode
 from auth import auth_needed, Auth
+from objects import Mark
 
 bp = Blueprint("mark", __name__, url_prefix = "/mark")
 
@@ -9,8 +10,15 @@ bp = Blueprint("mark", __name__, url_prefix = "/mark")
 @auth_needed(Auth.ANY)
 async def get_marks():
     """Abstract interface between the data and the user. Either `group`, `task`, `student`, `mark` must be
-    noted in the query string of the request."""
+    noted in the query string of the request. The attributes returned can be narrowed with ?fields=, e.g. ?fields=student_id,score
+    Marks from a past academic year are returned from the archive with ?year=, e.g. ?year=2023 for 2023/24."""
     marks = current_app.config['mark_manager']
+    as_json = current_app.config.get('json_fast_path', False) # Have the database build the response
+    try:
+        fields = parse_fields(request.args.get("fields"), Mark.public_fields())
+        year = parse_year(request.args.get("year"))
+    except ValueError:
+        return '', HTTPCode.BADREQUEST
 
     student_id = request.args.get("student") or None
     group_id = request.args.get("group") or None
@@ -20,26 +28,26 @@ async def get_marks():
     if student_id:
         if not student_id.isdigit():
             return '', HTTPCode.BADREQUEST
-        data = await marks.get(student_id = int(student_id))
-        return stringify(data), HTTPCode.OK
+        data = await marks.get(student_id = int(student_id), fields = fields, year = year, as_json = as_json)
+        return stringify_list(data), HTTPCode.OK
     
     elif group_id:
         if not group_id.isdigit():
             return '', HTTPCode.BADREQUEST
-        data = await marks.get(group_id = int(group_id))
-        return stringify(data), HTTPCode.OK
+        data = await marks.get(group_id = int(group_id), fields = fields, year = year, as_json = as_json)
+        return stringify_list(data), HTTPCode.OK
     
     elif task_id:
         if not task_id.isdigit():
             return '', HTTPCode.BADREQUEST
-        data = await marks.get(task_id = int(task_id))
-        return stringify(data), HTTPCode.OK
+        data = await marks.get(task_id = int(task_id), fields = fields, year = year, as_json = as_json)
+        return stringify_list(data), HTTPCode.OK
     
     elif mark_id:
         if not mark_id.isdigit():
             return '', HTTPCode.BADREQUEST
-        data = await marks.get(mark_id = int(mark_id))
-        return stringify(data), HTTPCode.OK
+        data = await marks.get(mark_id = int(mark_id), fields = fields, year = year, as_json = as_json)
+        return stringify_list(data), HTTPCode.OK
     
     else:
         return '', HTTPCode.BADREQUEST
@@ -0,0 +1,117 @@
+from quart import Blueprint, current_app
+import asyncio
+import threading
+import traceback
+import time
+import sys
+import json
+import logging
+from collections import deque
+from os import path
+from utils import HTTPCode
+from auth import auth_needed, Auth
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint("monitor", __name__, url_prefix = "/monitor")
+
+LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5] # Upper bounds, in seconds, of the lag histogram's buckets
+APP_ROOT = path.dirname(path.abspath(__file__))
+
+class LoopMonitor:
+    """Measures how late the event loop is in running a heartbeat that is scheduled every `interval` seconds. This lag is how
+    long every other coroutine on the worker was kept waiting by something running synchronously on the loop, e.g. hashing
+    a password or stringifying a big list. The lag is counted in a histogram. A watchdog thread also checks on the heartbeat,
+    and if the loop has been blocked for longer than `threshold` seconds it takes a sample of the loop thread's stack, so the
+    code that is blocking can be found. The line of this API's code nearest the top of each sample is counted in `sites`."""
+    def __init__(self, interval = 0.05, threshold = 0.1, samples = 50, *args, **kwargs):
+        self.interval = interval
+        self.threshold = threshold
+        self.counts = [0] * (len(LAG_BUCKETS) + 1) # The last bucket is for lags longer than the last bound
+        self.total = 0
+        self.max_lag = 0
+        self.samples = deque(maxlen = samples) # The most recent stack samples, as dictionaries
+        self.sites = {} # Key is "file:line (function)", value is the number of samples it was in
+        self.last_beat = time.monotonic()
+        self.sampled = False # True once the current block has been sampled, so each block is sampled once
+        self.loop_thread = None
+        self.task = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock() # Guards `samples` and `sites`, which the watchdog thread writes to
+
+    def start(self):
+        """Starts the heartbeat on the running loop and the watchdog thread."""
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.ensure_future(self.heartbeat())
+        threading.Thread(target = self.watchdog, name = "loop-watchdog", daemon = True).start()
+
+    async def heartbeat(self):
+        """Sleeps for `interval` seconds at a time, and records how much longer than that it took to be woken up."""
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_beat = time.monotonic()
+            self.sampled = False
+            self.record(self.last_beat - before - self.interval)
+
+    def record(self, lag):
+        """Adds `lag` seconds to the histogram."""
+        lag = max(lag, 0)
+        for i, bound in enumerate(LAG_BUCKETS):
+            if lag <= bound:
+                break
+        else:
+            i = len(LAG_BUCKETS)
+        self.counts[i] += 1
+        self.total += 1
+        self.max_lag = max(self.max_lag, lag)
+        if lag > self.threshold:
+            logger.warning("Event loop was blocked for %.3f seconds", lag)
+
+    def watchdog(self):
+        """Runs in its own thread. Samples the loop thread's stack once whenever the heartbeat is more than `threshold` seconds late."""
+        while not self.stopping.wait(self.threshold / 2):
+            blocked = time.monotonic() - self.last_beat - self.interval
+            if blocked > self.threshold and not self.sampled:
+                self.sampled = True
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.sample(frame, blocked)
+
+    def sample(self, frame, blocked):
+        """Records the stack `frame` of the blocked loop, which had been blocked for `blocked` seconds when it was taken."""
+        stack = traceback.extract_stack(frame)
+        site = next((f"{path.basename(f.filename)}:{f.lineno} ({f.name})" for f in reversed(stack)
+            if f.filename.startswith(APP_ROOT) and path.basename(f.filename) != "monitor.py"), "unknown")
+        with self.lock:
+            self.sites[site] = self.sites.get(site, 0) + 1
+            self.samples.append({"time": time.time(), "blocked": blocked, "site": site, "stack": traceback.format_list(stack[-15:])})
+
+    def stats(self):
+        """Returns the histogram, the blocking sites and the recent stack samples as a dictionary."""
+        with self.lock:
+            sites, samples = dict(self.sites), list(self.samples)
+        return {
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "heartbeats": self.total,
+            "max_lag": self.max_lag,
+            "histogram": [{"le": bound, "count": count} for bound, count in zip(LAG_BUCKETS + ["inf"], self.counts)],
+            "sites": dict(sorted(sites.items(), key = lambda item: -item[1])),
+            "samples": samples,
+        }
+
+    def close(self):
+        """Stops the heartbeat and the watchdog thread."""
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
+
+@bp.route('/loop', methods = ['GET'])
+@auth_needed(Auth.TEACHER)
+async def loop_stats():
+    """Route that returns this worker's event loop lag histogram, the code most often found blocking the loop and recent
+    stack samples of it. Each worker has its own loop, so repeated requests may be answered by different workers. Teacher
+    authentication needed."""
+    return json.dumps(current_app.config['loop_monitor'].stats()), HTTPCode.OK
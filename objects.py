@@ -1,4 +1,5 @@
-from datetime import datetime # For the cache
+from datetime import datetime, timedelta # For the cache
+import asyncio
 
 class Cache:
     def __init__(self, limit, *args, **kwargs):
@@ -27,6 +28,7 @@ class Cache:
                     oldest_key = key
 
             del self.c[oldest_key]
+            del self.times[oldest_key]
 
     def get(self, key):
         """Gets the value from the cache, returns False if non-existent."""
@@ -36,21 +38,121 @@ class Cache:
             return out
         return False
 
-class AbstractBaseObject:
+class SingleFlight:
+    """Coalesces identical concurrent calls. While a call for a given key is in flight, any other call with the same key waits
+    for that call instead of starting its own, and they all receive the same result (or exception)."""
     def __init__(self, *args, **kwargs):
-        self.data = []
-    
-    def create_from(self): # Abstract method
-        pass
+        self.in_flight = {}
+
+    async def run(self, key, factory):
+        """Returns the result of `await factory()`, sharing it with any call for `key` that is already in flight."""
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(future) # Shielded so that one caller being cancelled doesn't cancel the query for everyone else
+
+class AuthorizationCache:
+    """Cache of the facts used in permission checks: the IDs of the groups each student is in ("student"), the IDs of the groups
+    each teacher owns ("teacher"), and the ID of the group of each task ("task"). Entries expire after `ttl` seconds so that changes
+    made by other workers are picked up, and the oldest entries are removed when there are more than `limit` of a kind."""
+    def __init__(self, limit = 4096, ttl = 60, *args, **kwargs):
+        self.limit = limit
+        self.ttl = timedelta(seconds = ttl)
+        self.facts = {"student": {}, "teacher": {}, "task": {}} # Value is a dictionary of key -> (value, time it expires)
+
+    def get(self, kind, key):
+        """Returns the cached value for `key` of `kind`, or None if it isn't cached or has expired."""
+        entry = self.facts[kind].get(key)
+        if entry is None or entry[1] < datetime.now():
+            return None
+        return entry[0]
+
+    def set(self, kind, key, value):
+        """Caches `value` for `key` of `kind`."""
+        facts = self.facts[kind]
+        facts.pop(key, None) # So that it moves to the end of the insertion order
+        facts[key] = (value, datetime.now() + self.ttl)
+        if len(facts) > self.limit:
+            del facts[next(iter(facts))] # Dictionaries keep insertion order, so this is the oldest entry
+
+    def discard(self, kind, key):
+        """Removes `key` of `kind` from the cache."""
+        self.facts[kind].pop(key, None)
+
+    def add_group(self, kind, key, group_id):
+        """Adds `group_id` to the cached groups of the student or teacher `key`, if they are cached."""
+        groups = self.get(kind, key)
+        if groups is not None:
+            groups.add(group_id)
+
+    def remove_group(self, kind, key, group_id):
+        """Removes `group_id` from the cached groups of the student or teacher `key`, if they are cached."""
+        groups = self.get(kind, key)
+        if groups is not None:
+            groups.discard(group_id)
+
+    def move_group(self, group_id, teacher_id):
+        """Records that `group_id` is now owned by `teacher_id`."""
+        for groups, _ in self.facts["teacher"].values():
+            groups.discard(group_id)
+        self.add_group("teacher", teacher_id, group_id)
+
+    def forget_group(self, group_id):
+        """Removes every fact about `group_id`, e.g. after it is deleted."""
+        for kind in ["student", "teacher"]:
+            for groups, _ in self.facts[kind].values():
+                groups.discard(group_id)
+        for task_id in [key for key, (value, _) in self.facts["task"].items() if value == group_id]:
+            del self.facts["task"][task_id]
+
+_UNSET = object() # Sentinel for an attribute that has not been set
+
+class AbstractBaseObject:
+    """Base class for the data objects. Each subclass lists its attributes in `__slots__`, in the same order as the columns of its
+    table, so objects have no per-instance __dict__ and don't keep a copy of the row they were made from. Attributes that are never
+    set (e.g. columns that weren't selected with ?fields=) are not serialised."""
+    __slots__ = ()
+    fields = () # The columns of the object's table, in order
+    hidden_fields = ("password", "salt") # Never serialised, and can't be selected with ?fields=
+    timestamp_fields = () # Columns that are datetimes, which json_object (see managers.py) has to format like __str__ does
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.serialised = sorted(x for x in cls.__slots__ if x not in cls.hidden_fields) # Sorted so that the JSON is in the same order as before slots were used
+
+    def __init__(self, *values, **attributes):
+        """Sets the attributes from `values` in the order of `__slots__`, and then any given by name in `attributes`."""
+        for attr, value in zip(self.__slots__, values):
+            setattr(self, attr, value)
+        for attr, value in attributes.items():
+            setattr(self, attr, value)
+
+    @classmethod
+    def create_from(cls, data: []):
+        """Creates an object from a row whose columns are in the order of `__slots__`. Any extra columns at the end of the row are ignored."""
+        return cls(*data)
+
+    @classmethod
+    def create_partial(cls, data):
+        """Creates an object from a row which only has some of the columns, e.g. from a query using ?fields=. Only the
+        attributes in the row are set, so only they are serialised."""
+        return cls(**dict(data.items()))
+
+    @classmethod
+    def public_fields(cls):
+        """Returns the fields that can be serialised and selected with ?fields=."""
+        return [field for field in cls.fields if field not in cls.hidden_fields]
 
     def __str__(self):
         """Gives the JSON representation of the object."""
         string = "{"
-        attrs = [x for x in dir(self) if (not x.startswith("__") and not x.endswith("__") and x not in ["make_copy", "create_from", "data", "password", "salt"])] # This line gets all attributes of the object, not including methods, `data`, `password`, and `salt`
+        attrs = [(attr, getattr(self, attr, _UNSET)) for attr in self.serialised]
+        attrs = [(attr, val) for attr, val in attrs if val is not _UNSET] # Attributes that haven't been set are left out
         i = len(attrs) # Counter used to see if the element being added is the last one (if so it doesn't need a ",")
-        for attr in attrs:
+        for attr, val in attrs:
             i -= 1
-            val = getattr(self, attr)
             if val == None:
                 string += f'"{attr}": null'
             elif type(val) == str or type(val) == datetime:
@@ -71,96 +173,41 @@ class AbstractBaseObject:
 
         string += "}"
         return string
-        
-        #return "[" + ', '.join([str(attr) for attr in self.data]) + "]" Old __str__ method
 
     def __repr__(self):
         return self.__str__()
 
+    def copy_with(self, **changes):
+        """Returns a new copy of the object with the attributes in `changes` replaced."""
+        copy = self.__class__.__new__(self.__class__)
+        for attr in self.__slots__:
+            val = getattr(self, attr, _UNSET)
+            if val is not _UNSET:
+                setattr(copy, attr, val)
+        for attr, val in changes.items():
+            setattr(copy, attr, val)
+        return copy
+
     def make_copy(self):
         '''Function that returns itself, but as a new copy'''
-        return self.create_from(self.data[:])
+        return self.copy_with()
 
 class Student(AbstractBaseObject):
     """This class is just a structure of data, and does not have any methods"""
-    @classmethod
-    def create_from(cls, data: [], *args, **kwargs):
-        """Data supplied must follow [id, forename, surname, username, salt, password, alps]."""
-        super().__init__(cls)
-        self = Student()
-        self.data = data
-        self.id = data[0]
-        self.forename = data[1]
-        self.surname = data[2]
-        self.username = data[3]
-        self.salt = data[4]
-        self.password = data[5]
-        self.alps = data[6]
-        return self
+    __slots__ = fields = ("id", "forename", "surname", "username", "salt", "password", "alps")
 
 class Teacher(AbstractBaseObject):
     """This class is just a structure of data, and does not have any methods"""
-    @classmethod
-    def create_from(cls, data: [], *args, **kwargs):
-        """Data supplied must follow: [id, forename, surname, username, title, password, salt]."""
-        super().__init__(cls)
-        self = Teacher()
-        self.data = data
-        self.id = data[0]
-        self.forename = data[1]
-        self.surname = data[2]
-        self.username = data[3]
-        self.title = data[4]
-        self.password = data[5]
-        self.salt = data[6]
-        return self
-    
+    __slots__ = fields = ("id", "forename", "surname", "username", "title", "password", "salt")
+
 class Group(AbstractBaseObject):
-    @classmethod
-    def create_from(cls, data: [], *args, **kwargs):
-        """Data supplied must follow: [id, teacher_id, name, subject]"""
-        super().__init__(cls)
-        self = Group()
-        self.data = data
-        self.id = data[0]
-        self.teacher_id = data[1]
-        self.name = data[2]
-        self.subject = data[3]
-        return self
+    __slots__ = fields = ("id", "teacher_id", "name", "subject")
 
 class Task(AbstractBaseObject):
-    @classmethod
-    def create_from(cls, data: [], *args, **kwargs):
-        """Data supplied must follow: [id, group_id, description, date_set, date_due, max_score, has_completed = False]"""
-        super().__init__(cls)
-        self = Task()
-        self.data = data
-        self.id = data[0]
-        self.group_id = data[1]
-        self.title = data[2]
-        self.description = data[3]
-        self.date_set = data[4]
-        self.date_due = data[5]
-        self.max_score = data[6]
-        try:
-            self.has_completed = data[7]
-        except IndexError:
-            pass
-
-        return self
+    """`has_completed` is only set when the task was fetched for a student with get_completed."""
+    fields = ("id", "group_id", "title", "description", "date_set", "date_due", "max_score")
+    __slots__ = fields + ("has_completed",)
+    timestamp_fields = ("date_set", "date_due")
 
 class Mark(AbstractBaseObject):
-    @classmethod
-    def create_from(cls, data: [], *args, **kwargs):
-        """Data supplied must follow: [student_id, task_id, has_completed, has_marked, score, feedback]"""
-        super().__init__(cls)
-        self = Task()
-        self.data = data
-        self.student_id = data[0]
-        self.task_id = data[1]
-        self.has_completed = data[2]
-        self.has_marked = data[3]
-        self.score = data[4]
-        self.feedback = data[5]
-
-        return self
+    __slots__ = fields = ("student_id", "task_id", "has_completed", "has_marked", "score", "feedback")
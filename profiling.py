@@ -0,0 +1,118 @@
+from quart import request, g
+from os import environ, path, makedirs
+import cProfile
+import pstats
+import random
+import tempfile
+import json
+import time
+import logging
+from utils import is_admin_code_valid
+
+logger = logging.getLogger(__name__)
+
+def component(filename, function):
+    """Returns which part of the API the function `function` in the file `filename` belongs to, for the breakdown of a profile."""
+    name = path.basename(filename)
+    if name == "auth.py":
+        return "auth" # auth_needed and hash_func
+    if name == "managers.py":
+        return "managers"
+    if name == "database.py" or "asyncpg" in filename:
+        return "database"
+    if (name == "utils.py" and function == "stringify") or name == "objects.py":
+        return "stringify" # stringify and the __str__ of every object it turns into JSON
+    return "other"
+
+def breakdown(profile, top = 20):
+    """Returns a dictionary of the time spent in each component of the API (see `component`), and the `top` functions
+    that took the most time themselves. The times are the functions' own time, not including the functions they call."""
+    stats = pstats.Stats(profile).stats # Key is (filename, line, function), value is (primitive calls, calls, own time, cumulative time, callers)
+    components, functions = {}, []
+    for (filename, line, function), (_, calls, own, cumulative, callers) in stats.items():
+        if filename == "~" and callers:
+            # Built in functions (e.g. sha256 in hash_func) count towards the component of the caller that spent the most time in them
+            caller = max(callers, key = lambda key: callers[key][2])
+            part = component(caller[0], caller[2])
+        else:
+            part = component(filename, function)
+        components[part] = components.get(part, 0) + own
+        functions.append({"function": f"{path.basename(filename)}:{line}({function})", "component": part, "calls": calls, "own": own, "cumulative": cumulative})
+    functions.sort(key = lambda x: -x["own"])
+    return {"components": components, "functions": functions[:top]}
+
+class RequestProfiler:
+    """Profiles a request with cProfile when it has an X-Profile header holding the admin code, or for a random `sample_rate`
+    fraction of requests. Only one request is profiled at a time, as cProfile profiles the whole thread. The profile still
+    includes other requests that run while the profiled one is waiting on the database, which shows up as time in "other".
+    The profile is written to `directory` as a .prof file that can be opened with pstats or snakeviz. An admin can instead have
+    the breakdown returned in place of the response body by also sending `X-Profile-Output: inline`."""
+    def __init__(self, directory, sample_rate = 0.0, *args, **kwargs):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.profile = None # The profile of the request being profiled, if there is one
+
+    def asked_by_admin(self):
+        """Returns True if the current request has an X-Profile header holding the admin code."""
+        code = request.headers.get("X-Profile")
+        return bool(code and environ.get("ADMIN") and is_admin_code_valid(code))
+
+    def wanted(self):
+        """Returns True if the current request should be profiled."""
+        return self.asked_by_admin() or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def start(self):
+        """Starts profiling the current request if it should be profiled and no other request is being profiled."""
+        if self.profile is None and self.wanted():
+            g.profiled = True
+            # Only an admin may have the profile in place of the response, as it shows the server's code and file paths
+            g.profile_inline = request.headers.get("X-Profile-Output") == "inline" and self.asked_by_admin()
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    async def stop(self, response):
+        """Stops profiling the current request, if it is being profiled, and writes or returns the profile."""
+        if not g.get("profiled"):
+            return response
+        g.profiled = False
+        profile, self.profile = self.profile, None
+        profile.disable()
+        report = breakdown(profile)
+        report["endpoint"] = request.endpoint
+        report["status"] = response.status_code
+
+        if g.get("profile_inline"):
+            response.set_data(json.dumps(report))
+            response.headers["Content-Type"] = "application/json"
+            return response
+
+        makedirs(self.directory, exist_ok = True)
+        filename = path.join(self.directory, f"{int(time.time() * 1000)}-{request.endpoint}.prof")
+        profile.dump_stats(filename)
+        logger.info("Profiled %s %s to %s: %s", request.method, request.path, filename, {k: round(v, 4) for k, v in report["components"].items()})
+        response.headers["X-Profile-File"] = path.basename(filename)
+        return response
+
+    def abandon(self):
+        """Stops profiling without a report if the request failed before `stop` ran, so the next request can be profiled."""
+        if g.get("profiled") and self.profile is not None:
+            self.profile.disable()
+            self.profile = None
+
+def register(app):
+    """Adds on-demand profiling to `app`. Profiles are written to PROFILE_DIR (a temporary directory by default), and a
+    PROFILE_SAMPLE_RATE fraction of all requests (none by default) are profiled as well as those asked for by an admin.
+    This must be registered last, so the profiler stops before the other after_request functions (e.g. compression) run."""
+    profiler = RequestProfiler(environ.get('PROFILE_DIR', path.join(tempfile.gettempdir(), "trackr-profiles")), float(environ.get('PROFILE_SAMPLE_RATE', 0)))
+
+    @app.before_request
+    async def start_profile():
+        profiler.start()
+
+    @app.after_request
+    async def stop_profile(response):
+        return await profiler.stop(response)
+
+    @app.teardown_request
+    async def abandon_profile(exc):
+        profiler.abandon()
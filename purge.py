@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from managers import DELETED_STUDENTS, DELETED_GROUPS
+from idempotency import IDEMPOTENCY_TTL
+
+logger = logging.getLogger(__name__)
+
+# Each step deletes at most $1 rows that depend on a deleted student, teacher or group, and the rows are chosen with
+# FOR UPDATE SKIP LOCKED so that every worker can purge at the same time without waiting on each other. The steps are
+# ordered so that rows are only deleted once nothing depends on them, meaning an ON DELETE CASCADE never has anything
+# left to do and no statement holds more than a batch of locks.
+PURGE_STEPS = [
+    ("marks", f"""DELETE FROM mark_tbl WHERE id IN (SELECT id FROM mark_tbl
+WHERE student_id IN {DELETED_STUDENTS} OR task_id IN (SELECT id FROM task WHERE group_id IN {DELETED_GROUPS})
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    ("archived marks", f"""DELETE FROM mark_archive WHERE (id, academic_year) IN (SELECT id, academic_year FROM mark_archive
+WHERE student_id IN {DELETED_STUDENTS} OR task_id IN (SELECT id FROM task_archive WHERE group_id IN {DELETED_GROUPS})
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    ("tasks", f"""DELETE FROM task WHERE id IN (SELECT id FROM task
+WHERE group_id IN {DELETED_GROUPS} AND NOT EXISTS (SELECT 1 FROM mark_tbl WHERE task_id = task.id)
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    ("archived tasks", f"""DELETE FROM task_archive WHERE (id, academic_year) IN (SELECT id, academic_year FROM task_archive
+WHERE group_id IN {DELETED_GROUPS} AND NOT EXISTS (SELECT 1 FROM mark_archive WHERE task_id = task_archive.id)
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    ("memberships", f"""DELETE FROM student_group WHERE (student_id, group_id) IN (SELECT student_id, group_id FROM student_group
+WHERE student_id IN {DELETED_STUDENTS} OR group_id IN {DELETED_GROUPS}
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    ("groups", """DELETE FROM group_tbl WHERE id IN (SELECT id FROM group_tbl
+WHERE deleted_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM task WHERE group_id = group_tbl.id)
+AND NOT EXISTS (SELECT 1 FROM task_archive WHERE group_id = group_tbl.id) AND NOT EXISTS (SELECT 1 FROM student_group WHERE group_id = group_tbl.id)
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    ("students", """DELETE FROM student WHERE id IN (SELECT id FROM student
+WHERE deleted_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM mark_tbl WHERE student_id = student.id)
+AND NOT EXISTS (SELECT 1 FROM mark_archive WHERE student_id = student.id) AND NOT EXISTS (SELECT 1 FROM student_group WHERE student_id = student.id)
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    ("teachers", """DELETE FROM teacher WHERE id IN (SELECT id FROM teacher
+WHERE deleted_at IS NOT NULL AND NOT EXISTS (SELECT 1 FROM group_tbl WHERE teacher_id = teacher.id)
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+    # Not a deleted row, but stored responses for idempotency keys (see idempotency.py) are cleared out in the same way once expired
+    ("idempotency keys", f"""DELETE FROM idempotency_key WHERE (scope, key) IN (SELECT scope, key FROM idempotency_key
+WHERE created_at < now() AT TIME ZONE 'utc' - interval '{IDEMPOTENCY_TTL}'
+LIMIT $1 FOR UPDATE SKIP LOCKED);"""),
+]
+
+class PurgeWorker:
+    """Background task that removes deleted students, teachers and groups from the database, along with everything that
+    depends on them. Deleting only sets deleted_at, which hides the row from the managers straight away, so the request
+    doesn't wait for a cascade over thousands of rows. The purge then happens here in batches of `batch_size` rows, with
+    `pause` seconds between batches, and checks for new deletes every `interval` seconds once there is nothing left."""
+    def __init__(self, db, interval = 60, batch_size = 500, pause = 0.1, *args, **kwargs):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.task = None
+
+    def start(self):
+        """Starts purging in the background."""
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """Background task that purges a batch at a time until there is nothing left, then waits `interval` seconds."""
+        while True:
+            try:
+                purged = await self.purge_batch()
+            except Exception:
+                logger.exception("Purging deleted rows failed, retrying in %d seconds", self.interval)
+                purged = 0
+            await asyncio.sleep(self.pause if purged else self.interval)
+
+    async def purge_batch(self):
+        """Runs every step in PURGE_STEPS once, each in its own short transaction. Returns the number of rows deleted."""
+        total = 0
+        for name, sql in PURGE_STEPS:
+            status = await self.db.execute(sql, self.batch_size)
+            count = int(status.split()[-1]) # The status is e.g. `DELETE 500`
+            if count:
+                logger.debug("Purged %d %s", count, name)
+            total += count
+        return total
+
+    def close(self):
+        """Stops purging. Anything not yet purged stays hidden and is purged after the next startup."""
+        if self.task:
+            self.task.cancel()
@@ -0,0 +1,238 @@
+import logging
+from os import environ
+
+logger = logging.getLogger(__name__)
+
+# Each migration is a (version, sql) pair. Migrations are applied in order and the highest version applied is stored in the
+# schema_version table, so a new migration must always be appended to the end of this list with the next version number.
+MIGRATIONS = [
+    (1, """
+CREATE TABLE IF NOT EXISTS teacher (
+    id SERIAL PRIMARY KEY,
+    forename TEXT NOT NULL,
+    surname TEXT NOT NULL,
+    username TEXT NOT NULL,
+    title TEXT NOT NULL,
+    password TEXT,
+    salt TEXT
+);
+CREATE TABLE IF NOT EXISTS student (
+    id SERIAL PRIMARY KEY,
+    forename TEXT NOT NULL,
+    surname TEXT NOT NULL,
+    username TEXT NOT NULL,
+    salt TEXT,
+    password TEXT,
+    alps INTEGER
+);
+CREATE TABLE IF NOT EXISTS group_tbl (
+    id SERIAL PRIMARY KEY,
+    teacher_id INTEGER NOT NULL REFERENCES teacher (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    subject TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS student_group (
+    student_id INTEGER NOT NULL REFERENCES student (id) ON DELETE CASCADE,
+    group_id INTEGER NOT NULL REFERENCES group_tbl (id) ON DELETE CASCADE,
+    PRIMARY KEY (student_id, group_id)
+);
+CREATE TABLE IF NOT EXISTS task (
+    id SERIAL PRIMARY KEY,
+    group_id INTEGER NOT NULL REFERENCES group_tbl (id) ON DELETE CASCADE,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    date_set TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    date_due TIMESTAMP NOT NULL,
+    max_score INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS mark_tbl (
+    student_id INTEGER NOT NULL REFERENCES student (id) ON DELETE CASCADE,
+    task_id INTEGER NOT NULL REFERENCES task (id) ON DELETE CASCADE,
+    has_completed BOOLEAN NOT NULL DEFAULT FALSE,
+    has_marked BOOLEAN NOT NULL DEFAULT FALSE,
+    score INTEGER,
+    feedback TEXT,
+    id SERIAL PRIMARY KEY
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS student_username_key ON student (username);
+CREATE UNIQUE INDEX IF NOT EXISTS teacher_username_key ON teacher (username);
+CREATE INDEX IF NOT EXISTS student_salt_idx ON student (salt);
+CREATE INDEX IF NOT EXISTS teacher_salt_idx ON teacher (salt);
+CREATE INDEX IF NOT EXISTS group_tbl_teacher_id_idx ON group_tbl (teacher_id);
+CREATE INDEX IF NOT EXISTS student_group_group_id_idx ON student_group (group_id);
+CREATE INDEX IF NOT EXISTS task_group_id_idx ON task (group_id);
+CREATE UNIQUE INDEX IF NOT EXISTS mark_tbl_student_id_task_id_key ON mark_tbl (student_id, task_id);
+CREATE INDEX IF NOT EXISTS mark_tbl_task_id_idx ON mark_tbl (task_id);
+"""),
+    (2, """
+CREATE INDEX IF NOT EXISTS task_group_id_date_due_idx ON task (group_id, date_due);
+DROP INDEX IF EXISTS task_group_id_idx;
+"""),
+    (3, """
+CREATE TABLE IF NOT EXISTS task_archive (
+    id INTEGER NOT NULL,
+    group_id INTEGER NOT NULL REFERENCES group_tbl (id) ON DELETE CASCADE,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    date_set TIMESTAMP NOT NULL,
+    date_due TIMESTAMP NOT NULL,
+    max_score INTEGER NOT NULL,
+    academic_year INTEGER NOT NULL,
+    PRIMARY KEY (id, academic_year)
+) PARTITION BY LIST (academic_year);
+CREATE TABLE IF NOT EXISTS mark_archive (
+    student_id INTEGER NOT NULL REFERENCES student (id) ON DELETE CASCADE,
+    task_id INTEGER NOT NULL,
+    has_completed BOOLEAN NOT NULL,
+    has_marked BOOLEAN NOT NULL,
+    score INTEGER,
+    feedback TEXT,
+    id INTEGER NOT NULL,
+    academic_year INTEGER NOT NULL,
+    PRIMARY KEY (id, academic_year),
+    FOREIGN KEY (task_id, academic_year) REFERENCES task_archive (id, academic_year) ON DELETE CASCADE
+) PARTITION BY LIST (academic_year);
+
+CREATE INDEX IF NOT EXISTS task_archive_group_id_idx ON task_archive (group_id);
+CREATE INDEX IF NOT EXISTS mark_archive_student_id_idx ON mark_archive (student_id);
+CREATE INDEX IF NOT EXISTS mark_archive_task_id_idx ON mark_archive (task_id);
+"""),
+    (4, """
+ALTER TABLE student ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+ALTER TABLE teacher ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+ALTER TABLE group_tbl ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS student_deleted_idx ON student (id) WHERE deleted_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS teacher_deleted_idx ON teacher (id) WHERE deleted_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS group_tbl_deleted_idx ON group_tbl (id) WHERE deleted_at IS NOT NULL;
+"""),
+    (5, """
+CREATE TABLE IF NOT EXISTS idempotency_key (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    status INTEGER,
+    body TEXT,
+    headers TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+    PRIMARY KEY (scope, key)
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_key_created_at_idx ON idempotency_key (created_at);
+"""),
+]
+
+# The indexes that the queries in managers.py rely on, given as (table, columns, unique). An existing index satisfies a
+# requirement if `columns` is a leading prefix of its columns, or if unique is needed, the columns match exactly.
+REQUIRED_INDEXES = [
+    ("student", ("id",), True),
+    ("student", ("username",), True),
+    ("student", ("salt",), False),
+    ("teacher", ("id",), True),
+    ("teacher", ("username",), True),
+    ("teacher", ("salt",), False),
+    ("group_tbl", ("id",), True),
+    ("group_tbl", ("teacher_id",), False),
+    ("student_group", ("student_id",), False),
+    ("student_group", ("group_id",), False),
+    ("task", ("id",), True),
+    ("task", ("group_id", "date_due"), False),
+    ("mark_tbl", ("id",), True),
+    ("mark_tbl", ("student_id", "task_id"), True),
+    ("mark_tbl", ("task_id",), False),
+    ("task_archive", ("group_id",), False),
+    ("mark_archive", ("student_id",), False),
+    ("mark_archive", ("task_id",), False),
+    ("idempotency_key", ("scope", "key"), True),
+    ("idempotency_key", ("created_at",), False),
+]
+
+# Key of the advisory lock held while creating schema_version or applying a migration, so that workers started together
+# with AUTO_MIGRATE wait for each other instead of racing to apply the same migration
+MIGRATION_LOCK = 720026
+
+async def current_version(db):
+    """Returns the highest migration version that has been applied to the database, 0 if none have."""
+    await db.execute(f"""SELECT pg_advisory_xact_lock({MIGRATION_LOCK});
+CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TIMESTAMP NOT NULL DEFAULT now());""")
+    data = await db.fetchrow("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version;", primary = True)
+    return data.get("version")
+
+async def migrate(db):
+    """Applies every migration in MIGRATIONS that has not been applied yet. Returns the version the database is now at.
+    Each migration is applied in its own transaction holding MIGRATION_LOCK, and the version is read again once the lock is
+    held, so a migration another worker applied meanwhile is skipped."""
+    version = await current_version(db)
+    for number, sql in MIGRATIONS:
+        if number <= version:
+            continue
+        async with db.acquire(db.pool) as connection:
+            async with connection.transaction(): # A failed migration is rolled back and not recorded
+                await connection.execute("SELECT pg_advisory_xact_lock($1);", MIGRATION_LOCK)
+                version = await connection.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+                if number <= version:
+                    continue
+                logger.info("Applying schema migration %d", number)
+                await connection.execute(sql)
+                await connection.execute("INSERT INTO schema_version (version) VALUES ($1);", number)
+                version = number
+    return version
+
+async def missing_indexes(db):
+    """Returns a list of (table, columns, unique) from REQUIRED_INDEXES which no index in the database satisfies."""
+    tables = list({table for table, _, _ in REQUIRED_INDEXES})
+    data = await db.fetch("""SELECT t.relname AS table_name, i.indisunique AS is_unique, array_agg(a.attname ORDER BY k.n) AS columns
+FROM pg_index i
+INNER JOIN pg_class t ON t.oid = i.indrelid
+INNER JOIN pg_namespace ns ON ns.oid = t.relnamespace AND ns.nspname = current_schema()
+INNER JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) ON true
+INNER JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+WHERE t.relname = ANY($1::text[]) AND i.indpred IS NULL
+GROUP BY t.relname, i.indexrelid, i.indisunique;""", tables)
+
+    existing = {}
+    for row in data:
+        existing.setdefault(row.get("table_name"), []).append((tuple(row.get("columns")), row.get("is_unique")))
+
+    missing = []
+    for table, columns, unique in REQUIRED_INDEXES:
+        satisfied = False
+        for index_columns, index_unique in existing.get(table, []):
+            if unique:
+                satisfied = index_unique and set(index_columns) == set(columns)
+            else:
+                satisfied = index_columns[:len(columns)] == columns
+            if satisfied:
+                break
+        if not satisfied:
+            missing.append((table, columns, unique))
+    return missing
+
+async def check_schema(db):
+    """Called on startup. Migrates the database if the AUTO_MIGRATE environment variable is set, then logs a warning for
+    any migration that has not been applied and any index that the managers rely on that does not exist."""
+    if environ.get("AUTO_MIGRATE"):
+        await migrate(db)
+
+    version = await current_version(db)
+    latest = MIGRATIONS[-1][0]
+    if version < latest:
+        logger.warning("Database schema is at version %d but the latest is %d, run `python schema.py` to migrate", version, latest)
+
+    for table, columns, unique in await missing_indexes(db):
+        logger.warning("Missing %sindex on %s (%s), lookups on it will be sequential scans", "unique " if unique else "", table, ", ".join(columns))
+
+if __name__ == "__main__":
+    import asyncio
+    from database import DatabaseHandler
+    from tenancy import tenant_urls
+
+    async def main():
+        for name, url in tenant_urls().items(): # Every school's database is migrated
+            db = await DatabaseHandler.create(url, [], pool_size = 2) # Kept small so it fits alongside a running app, see serve.py
+            version = await migrate(db)
+            print(f"{name}: database schema is at version {version}")
+            await db.close()
+
+    asyncio.run(main())
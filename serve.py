@@ -0,0 +1,61 @@
+from hypercorn.config import Config
+from hypercorn.run import run
+from os import environ, cpu_count
+from urllib.parse import urlparse
+from tenancy import tenant_urls
+import importlib.util
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+def worker_count():
+    """Returns how many worker processes to run. WEB_CONCURRENCY is set by Heroku for the dyno size, otherwise there is one per CPU."""
+    return max(int(environ.get('WEB_CONCURRENCY', 0)) or cpu_count() or 1, 1)
+
+def pools_per_server():
+    """Returns the most tenants (see tenancy.py) whose databases are on the same Postgres server, as every worker has a pool
+    for each of them and they all count towards that server's max_connections."""
+    servers = {}
+    for url in tenant_urls().values():
+        address = urlparse(url or "")
+        server = (address.hostname, address.port)
+        servers[server] = servers.get(server, 0) + 1
+    return max(servers.values(), default = 1)
+
+def pool_size(workers):
+    """Returns how many connections each pool may open so that every worker's pools together stay within DB_MAX_CONNECTIONS,
+    the max_connections of each Postgres server, keeping DB_RESERVED_CONNECTIONS free. The reserved connections are for
+    `python schema.py`, benchmarks/replay.py (2 each) and psql. Returns None if DB_MAX_CONNECTIONS isn't set."""
+    limit = environ.get('DB_MAX_CONNECTIONS')
+    if not limit:
+        return None
+    available = int(limit) - int(environ.get('DB_RESERVED_CONNECTIONS', 5))
+    pools = workers * pools_per_server()
+    size = available // pools
+    if size < 2:
+        # A pool needs one connection for LISTEN (see EventBroker) and at least one for queries
+        sys.exit(f"{pools} pools can't share {available} connections, lower WEB_CONCURRENCY or raise DB_MAX_CONNECTIONS")
+    return size
+
+def make_config():
+    """Returns the hypercorn configuration for production."""
+    config = Config()
+    config.application_path = "__init__:app"
+    config.bind = [f"0.0.0.0:{environ.get('PORT', 8000)}"]
+    config.workers = worker_count()
+    config.worker_class = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio" # uvloop is a faster event loop, used if it is installed
+    config.keep_alive_timeout = float(environ.get('KEEP_ALIVE_TIMEOUT', 75)) # Longer than the Heroku router's 55 second idle timeout, so the router always closes first
+    config.backlog = int(environ.get('BACKLOG', 2048)) # Connections the OS queues while every worker is busy, e.g. the night before a deadline
+    config.graceful_timeout = float(environ.get('GRACEFUL_TIMEOUT', 25)) # Heroku kills a dyno 30 seconds after asking it to stop
+    config.accesslog = "-" if environ.get('ACCESS_LOG') else None
+    return config
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.INFO)
+    config = make_config()
+    size = pool_size(config.workers)
+    if size:
+        environ['DB_POOL_SIZE'] = str(size) # The workers are spawned after this, so they inherit it
+    logger.info("Starting %d %s workers with %s connections per pool", config.workers, config.worker_class, environ.get('DB_POOL_SIZE', 20))
+    sys.exit(run(config))
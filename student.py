@@ -1,7 +1,8 @@
 ﻿from quart import Blueprint, request, current_app
-from utils import stringify, is_password_sufficient # Functions
+from utils import stringify, is_password_sufficient, parse_fields # Functions
 from utils import HTTPCode # Enumeratons
-from auth import get_auth_details, hash_func, auth_needed, Auth
+from auth import get_auth_details, hash_func, auth_needed, Auth, throttled_response, record_login
+from idempotency import idempotent
 from objects import Student
 from exceptions import UsernameTaken
 
@@ -17,8 +18,14 @@ async def auth():
     password = data.get("password")
     if not (username and password):
         return '', HTTPCode.BADREQUEST
-    
-    if await student_manager.is_student_valid(username, password):
+
+    throttled = throttled_response(username, login = True)
+    if throttled:
+        return throttled
+
+    valid = await student_manager.is_student_valid(username, password)
+    record_login(username, valid)
+    if valid:
         return '', HTTPCode.OK
     else:
         return '', HTTPCode.UNAUTHORIZED
@@ -59,14 +66,19 @@ async def password_reset():
 @bp.route('/', methods = ['GET'])
 @auth_needed(Auth.ANY)
 async def get_students():
-    """/student route."""
+    """/student route. The attributes returned can be narrowed with ?fields=, e.g. ?fields=id,username"""
+    try:
+        fields = parse_fields(request.args.get("fields"), Student.public_fields())
+    except ValueError:
+        return '', HTTPCode.BADREQUEST
     students = current_app.config['student_manager']
-    data = await students.get()
+    data = await students.get(fields = fields)
     if not data:
         return '', HTTPCode.NOTFOUND
     return stringify(data), HTTPCode.OK
 
 @bp.route('/', methods = ['POST'])
+@idempotent
 @auth_needed(Auth.TEACHER)
 async def new_student():
     data = await request.form
@@ -1,9 +1,12 @@
 from quart import Blueprint, request, current_app
-from utils import stringify, parse_datetime
+from utils import stringify, stringify_list, parse_datetime, parse_fields, parse_task_query
 from utils import HTTPCode
 from auth import auth_needed, Auth
-from objects import Student
+from idempotency import idempotent
+from objects import Student, Task
 from exceptions import DateTimeParserError
+from events import reference
+import json
 
 bp = Blueprint("task", __name__, url_prefix = "/task")
 
@@ -13,29 +16,69 @@ async def get_all_tasks(auth_obj):
     """Route that gets all the tasks in the database. Any authentication necessary.
     Teacher auth -> all tasks returned
     Student auth -> student's tasks returned
-    No auth -> BADREQUEST"""
+    No auth -> BADREQUEST
+    The attributes returned can be narrowed with ?fields=, e.g. ?fields=id,title,date_due
+    The tasks can be filtered and sorted with ?due_before=, ?due_after=, ?completed= (students only), ?sort= and ?limit=, see parse_task_query.
+    Tasks from a past academic year are returned from the archive with ?year=."""
     tasks = current_app.config['task_manager']
     is_completed = request.args.get("is_completed") # Should be set to True if client wants the "has_completed" attribute
     is_mine = request.args.get("mine") == "True" # Used when a teacher wants to get their own tasks TODO: Perhaps make this a default thing - make default teacher funcitonaity return only the teacher's tasks
+    get_completed = type(auth_obj) == Student and is_completed == "True"
+    as_json = current_app.config.get('json_fast_path', False) # Have the database build the response
+    try:
+        fields = parse_fields(request.args.get("fields"), Task.public_fields() + (["has_completed"] if get_completed else []))
+        filters = parse_task_query(request.args)
+    except (ValueError, DateTimeParserError):
+        return '', HTTPCode.BADREQUEST
+    if "completed" in filters and type(auth_obj) != Student:
+        return '', HTTPCode.BADREQUEST # Only students have completed tasks
     
     if type(auth_obj) == Student:
         # Get only student's tasks
-        if is_completed == "True":
-            data = await tasks.get(student_id = auth_obj.id, get_completed = True)
+        if get_completed:
+            data = await tasks.get(student_id = auth_obj.id, get_completed = True, fields = fields, as_json = as_json, **filters)
         else:
-            data = await tasks.get(student_id = auth_obj.id)
+            data = await tasks.get(student_id = auth_obj.id, fields = fields, as_json = as_json, **filters)
     else:
         # Get the teacher's tasks (all the tasks from the database)
         if is_mine:
-            data = await tasks.get(teacher_id = auth_obj.id)
+            data = await tasks.get(teacher_id = auth_obj.id, fields = fields, as_json = as_json, **filters)
         else:
-            data = await tasks.get()
+            data = await tasks.get(fields = fields, as_json = as_json, **filters)
 
     if data:
-        return stringify(data), HTTPCode.OK
+        return stringify_list(data), HTTPCode.OK
     else:
         return '', HTTPCode.NOTFOUND
 
+@bp.route('/bulk', methods = ['POST'])
+@auth_needed(Auth.TEACHER, provide_obj = True)
+async def make_bulk_tasks(auth_obj):
+    """Route that sets the same task for many groups at once. The form-data is the same as POST /group/<id>/task, with
+    `groups` as a comma separated list of group IDs, all of which the teacher must own. The date due must be in UTC, and
+    the format: dd/mm/yyyy|hh:mm. Returns a reference to the new task in each group, in the same order as `groups`."""
+    data = await request.form
+    title = data.get("title") or None
+    description = data.get("description") or None
+    max_score = data.get("max_score") or None
+    groups = [group.strip() for group in (data.get("groups") or "").split(",") if group.strip()]
+
+    try:
+        date_due = parse_datetime(data.get("date_due") or None)
+    except Exception:
+        return '', HTTPCode.BADREQUEST
+
+    if not title or not description or not max_score or not max_score.isdigit() or not date_due or not groups or not all(group.isdigit() for group in groups):
+        return '', HTTPCode.BADREQUEST # Not all necessary args given, return BADREQUEST
+
+    tasks = current_app.config['task_manager']
+    group_ids = [int(group) for group in groups]
+    try:
+        created = await tasks.create_many(group_ids, title, description, date_due, int(max_score), auth_obj.id)
+    except PermissionError:
+        return '', HTTPCode.UNAUTHORIZED # Teacher cannot set tasks for groups they don't own
+    return json.dumps({"data": [reference("task", created[group_id]) for group_id in dict.fromkeys(group_ids)]}), HTTPCode.CREATED
+
 @bp.route('/<id>', methods = ['GET'])
 @auth_needed(Auth.ANY)
 async def get_task(id):
@@ -147,6 +190,9 @@ async def task_completed(id, auth_obj):
             return '', HTTPCode.UNAUTHORIZED # Unauthorized to change other peoples task statuses
 
     elif request.method == "GET":
+        completions = current_app.config.get('completion_queue')
+        if completions and completions.is_pending(auth_obj.id, task_id):
+            await completions.flush() # So the student sees the status they just set
         marks = current_app.config['mark_manager']
         mark = await marks.get(student_id = auth_obj.id, task_id = task_id)
         if mark:
@@ -185,6 +231,7 @@ async def get_task_marks(id):
     
 
 @bp.route('/<id>/provide_feedback', methods = ['POST'])
+@idempotent
 @auth_needed(Auth.TEACHER, provide_obj = True)
 async def prov_feedback(id, auth_obj):
     data = await request.form
@@ -204,4 +251,43 @@ async def prov_feedback(id, auth_obj):
         await tasks.provide_feedback(feedback, score, student_id, task_id, auth_obj)
         return '', HTTPCode.OK
     except PermissionError:
-        return '', HTTPCode.UNAUTHORIZED # Teacher cannot provide feedback to tasks they have not set
\ No newline at end of file
+        return '', HTTPCode.UNAUTHORIZED # Teacher cannot provide feedback to tasks they have not set
+
+@bp.route('/<id>/provide_feedback/bulk', methods = ['POST'])
+@auth_needed(Auth.TEACHER, provide_obj = True)
+async def prov_feedback_bulk(id, auth_obj):
+    """Route that provides feedback for many students at once. The body is a JSON array of objects with a `student` ID,
+    a `score` and an optional `feedback`. The response has the status of each object, in the same order, which is
+    OK if the mark was saved, BADREQUEST if it is invalid, or NOTFOUND if the student isn't in the task's group."""
+    body = await request.get_json(force = True, silent = True)
+    if not id.isdigit() or type(body) != list or not body:
+        return '', HTTPCode.BADREQUEST
+
+    marks = [] # The valid marks, as (student_id, score, feedback)
+    indexes = [] # The index in `body` of each of `marks`
+    results = [{"status": HTTPCode.BADREQUEST} for _ in body]
+    for i, row in enumerate(body):
+        if type(row) != dict:
+            continue
+        student_id = row.get("student")
+        score = row.get("score")
+        feedback = row.get("feedback") or "No feedback given."
+        if type(student_id) == str and student_id.isdigit(): student_id = int(student_id)
+        if type(score) == str and score.isdigit(): score = int(score)
+        if type(student_id) != int or type(score) != int or type(feedback) != str:
+            continue
+        results[i]["student"] = reference("student", student_id)
+        marks.append((student_id, score, feedback))
+        indexes.append(i)
+
+    if marks:
+        try:
+            tasks = current_app.config['task_manager']
+            statuses = await tasks.provide_feedback_bulk(int(id), marks, auth_obj)
+        except LookupError:
+            return '', HTTPCode.NOTFOUND
+        except PermissionError:
+            return '', HTTPCode.UNAUTHORIZED # Teacher cannot provide feedback to tasks they have not set
+        for i, status in zip(indexes, statuses):
+            results[i]["status"] = status
+    return json.dumps({"data": results}), HTTPCode.OK
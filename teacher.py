@@ -1,8 +1,9 @@
 ﻿from quart import Blueprint, request, current_app
-from utils import stringify, is_admin_code_valid, is_password_sufficient # Functions
+from utils import stringify, is_admin_code_valid, is_password_sufficient, parse_fields # Functions
 from utils import HTTPCode
-from auth import Auth, auth_needed, hash_func
+from auth import Auth, auth_needed, hash_func, throttled_response, record_login
 from exceptions import UsernameTaken
+from objects import Teacher
 
 bp = Blueprint("teacher", __name__, url_prefix = "/teacher")
 
@@ -17,7 +18,13 @@ async def auth():
     if not (username and password):
         return '', HTTPCode.BADREQUEST
 
-    if await teacher_manager.is_teacher_valid(username, password):
+    throttled = throttled_response(username, login = True)
+    if throttled:
+        return throttled
+
+    valid = await teacher_manager.is_teacher_valid(username, password)
+    record_login(username, valid)
+    if valid:
         return '', HTTPCode.OK
     else:
         return '', HTTPCode.UNAUTHORIZED
@@ -36,8 +43,12 @@ async def username_taken():
 @bp.route("/", methods = ["GET"])
 @auth_needed(Auth.ANY)
 async def get_teachers():
-    """/teacher route"""
-    teachers = await current_app.config['teacher_manager'].get()
+    """/teacher route. The attributes returned can be narrowed with ?fields=, e.g. ?fields=id,title,surname"""
+    try:
+        fields = parse_fields(request.args.get("fields"), Teacher.public_fields())
+    except ValueError:
+        return '', HTTPCode.BADREQUEST
+    teachers = await current_app.config['teacher_manager'].get(fields = fields)
     if not teachers:
         return '', HTTPCode.NOTFOUND
     return stringify(teachers), HTTPCode.OK
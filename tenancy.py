@@ -0,0 +1,107 @@
+from quart import request, websocket
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import environ
+from utils import HTTPCode
+from database import DatabaseHandler
+
+# The school (tenant) the current request is for. It is set before each request and websocket from the Host or X-Tenant
+# header, and decides which tenant's database, caches and managers are used.
+current_tenant = ContextVar("current_tenant", default = None)
+
+DEFAULT_TENANT = "default" # The only tenant when TENANT_DATABASE_URLS isn't set
+TENANTLESS_ENDPOINTS = {"root", "ready"} # Endpoints that don't need a tenant, e.g. for the load balancer's health checks
+
+def tenant_urls():
+    """Returns a dictionary of tenant name -> database URL. These come from the TENANT_DATABASE_URLS environment variable,
+    a comma separated list of name=url, e.g. `hillside=postgres://...,riverside=postgres://...`. If it isn't set there is
+    one tenant, "default", which uses DATABASE_URL."""
+    urls = {}
+    for pair in environ.get('TENANT_DATABASE_URLS', '').split(','):
+        if "=" in pair:
+            name, url = pair.split("=", 1)
+            urls[name.strip()] = url.strip()
+    return urls or {DEFAULT_TENANT: environ.get('DATABASE_URL')}
+
+@contextmanager
+def use_tenant(name):
+    """Makes `name` the current tenant inside the with block. Used for work done outside of a request, such as on startup."""
+    token = current_tenant.set(name)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+def resolve_tenant(incoming, tenants):
+    """Returns the name of the tenant that `incoming` (a request or websocket) is for, or None if it can't be found.
+    With one tenant every request is for it. Otherwise the first label of the Host header is used if it is a tenant's
+    name, e.g. hillside.trackr.example, else the X-Tenant header."""
+    if len(tenants) == 1:
+        return next(iter(tenants))
+    host = (incoming.host or "").split(":")[0]
+    subdomain = host.split(".")[0] if host.count(".") >= 2 else None
+    if subdomain in tenants:
+        return subdomain
+    name = incoming.headers.get("X-Tenant")
+    return name if name in tenants else None
+
+class TenantScoped:
+    """Holds one instance of something for each tenant, e.g. a manager or a cache, and passes every attribute lookup on to the
+    current tenant's instance. This means that each tenant's caches only ever hold that tenant's data, and code using
+    it can treat it as a single instance."""
+    def __init__(self, instances, *args, **kwargs):
+        self.instances = instances # Key is the tenant name
+
+    @classmethod
+    def build(cls, tenants, factory):
+        """Calls `factory` once for each tenant, with that tenant as the current tenant, and returns a TenantScoped of the results.
+        Background tasks started by `factory` keep that tenant as their current tenant."""
+        instances = {}
+        for name in tenants:
+            with use_tenant(name):
+                instances[name] = factory()
+        return cls(instances)
+
+    def current(self):
+        """Returns the current tenant's instance. Raises LookupError if there is no current tenant."""
+        name = current_tenant.get()
+        if name is None:
+            raise LookupError("There is no current tenant")
+        return self.instances[name]
+
+    def items(self):
+        """Returns (tenant name, instance) pairs for every tenant."""
+        return self.instances.items()
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+async def create_database_handlers():
+    """Creates a DatabaseHandler, with its own pool, for each tenant and returns them as a TenantScoped. Read replicas
+    from DATABASE_REPLICA_URLS are only used when there is a single tenant."""
+    urls = tenant_urls()
+    handlers = {}
+    for name, url in urls.items():
+        handlers[name] = await DatabaseHandler.create(url, None if len(urls) == 1 else [])
+    return TenantScoped(handlers)
+
+def register(app):
+    """Sets the current tenant before every request and websocket. Requests for an unknown tenant get a 404."""
+    tenants = set(tenant_urls())
+
+    async def set_tenant(incoming):
+        name = resolve_tenant(incoming, tenants)
+        if name is None:
+            if incoming.endpoint in TENANTLESS_ENDPOINTS:
+                return None
+            return '', HTTPCode.NOTFOUND
+        current_tenant.set(name) # Quart runs the before functions and the handler in the same context, so this lasts for the request
+        return None
+
+    @app.before_request
+    async def set_request_tenant():
+        return await set_tenant(request)
+
+    @app.before_websocket
+    async def set_websocket_tenant():
+        return await set_tenant(websocket)
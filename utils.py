@@ -12,6 +12,10 @@ class HTTPCode:
     BADREQUEST = 400
     UNAUTHORIZED = 401
     NOTFOUND = 404
+    CONFLICT = 409
+    UNPROCESSABLEENTITY = 422
+    TOOMANYREQUESTS = 429
+    SERVICEUNAVAILABLE = 503
 
 def stringify(data):
     """Wraps a 2D list of records, `data`, into JSON."""
@@ -27,6 +31,85 @@ def stringify(data):
             to_return += ', ' # This is placed between all elements apart from the last one
     return to_return + "]}"
 
+def stringify_list(data):
+    """Returns the response body for a list of records, `data`. With JSON_FAST_PATH the managers return the body already built
+    by the database as a string (or None if there were no records), which is returned unchanged."""
+    if data is None:
+        return stringify([])
+    if type(data) == str:
+        return data
+    return stringify(data)
+
+def parse_fields(string, allowed):
+    """Takes in the `fields` query string parameter, e.g. `id,title,date_due`, and returns the list of fields, or None if no fields were given.
+    Raises ValueError if any field is not in `allowed`. As the fields are checked against `allowed` they are safe to put into SQL."""
+    if not string: return None
+    fields = [field.strip() for field in string.split(",") if field.strip()]
+    if not fields or any(field not in allowed for field in fields):
+        raise ValueError
+    return list(dict.fromkeys(fields)) # Removes duplicates, keeping the order given
+
+TASK_SORT_FIELDS = ["id", "title", "date_set", "date_due", "max_score"]
+
+ACADEMIC_YEAR_START_MONTH = 9 # Academic years run from the 1st of September. This must match the interval in ACADEMIC_YEAR_SQL
+ACADEMIC_YEAR_SQL = "EXTRACT(YEAR FROM {} - INTERVAL '8 months')::int" # SQL for the academic year of a timestamp column
+
+def academic_year(date = None):
+    """Returns the academic year that `date` (defaulting to now, in UTC) is in, given as the calendar year it started in,
+    e.g. 2024 for September 2024 to August 2025."""
+    date = date or datetime.utcnow()
+    return date.year if date.month >= ACADEMIC_YEAR_START_MONTH else date.year - 1
+
+def academic_year_start(year):
+    """Returns the datetime that the academic year `year` starts at."""
+    return datetime(year, ACADEMIC_YEAR_START_MONTH, 1)
+
+def parse_year(string):
+    """Takes in the `year` query string parameter and returns it as an integer academic year, or None if it wasn't given.
+    Raises ValueError if it isn't a year."""
+    if not string: return None
+    if not string.isdigit() or len(string) != 4:
+        raise ValueError
+    return int(string)
+
+def parse_task_query(args):
+    """Takes in the query string of a request for a list of tasks and returns a dictionary of the filters given, which can be passed into TaskManager.get.
+    due_before / due_after: only tasks due before / after this time, in the format `dd/mm/yyyy|hh:mm`
+    completed: `true` or `false`, only tasks the student has or hasn't completed
+    sort: the field to sort by, which is sorted in descending order if it starts with `-`, e.g. `-date_due`
+    limit: the maximum number of tasks to return
+    year: the academic year to get tasks from, e.g. `2023` for 2023/24. Past years are read from the archive
+    Raises ValueError or DateTimeParserError if any of them are invalid."""
+    filters = {}
+    if args.get("due_before"):
+        filters["due_before"] = parse_datetime(args.get("due_before"))
+    if args.get("due_after"):
+        filters["due_after"] = parse_datetime(args.get("due_after"))
+
+    completed = args.get("completed")
+    if completed:
+        if completed not in ["true", "false"]:
+            raise ValueError
+        filters["completed"] = completed == "true"
+
+    sort = args.get("sort")
+    if sort:
+        column = sort[1:] if sort.startswith("-") else sort
+        if column not in TASK_SORT_FIELDS:
+            raise ValueError
+        filters["sort"] = (column, sort.startswith("-"))
+
+    limit = args.get("limit")
+    if limit:
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError
+        filters["limit"] = int(limit)
+
+    year = parse_year(args.get("year"))
+    if year:
+        filters["year"] = year
+    return filters
+
 def constant_time_string_check(given, actual):
     """A constant time string check that prevents timing attacks."""
     result = True
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CompletionWriteBehind:
+    """Queue for task completion toggles. The caller checks permissions and then submits the write, which is acknowledged straight away.
+    Repeated writes for the same (student, task) within `window` seconds are merged so only the last one is written, and every
+    `window` seconds the pending writes are flushed to mark_tbl in one statement. Each worker has its own queue, so two toggles
+    for the same student and task that land on different workers can be written in either order, and the earlier one may win.
+    This is only safe because a toggle is just a tick box that the student can click again."""
+    def __init__(self, db, window = 1.0, *args, **kwargs):
+        self.db = db
+        self.window = window
+        self.pending = {} # Key is (student_id, task_id), value is has_completed
+        self.task = None
+
+    def start(self):
+        """Starts flushing in the background."""
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """Background task that flushes the pending writes every `window` seconds."""
+        while True:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Flushing %d task completions failed, retrying next window", len(self.pending))
+
+    def submit(self, student_id, task_id, has_completed):
+        """Queues setting has_completed for the student and task, replacing any write for them that is still pending."""
+        self.pending[(student_id, task_id)] = has_completed
+
+    def is_pending(self, student_id, task_id):
+        """Returns True if there is a write for the student and task that hasn't been flushed."""
+        return (student_id, task_id) in self.pending
+
+    async def flush(self):
+        """Writes every pending write to the database in one statement. Writes for tasks or students that no longer exist (e.g.
+        a task deleted or archived while its toggle was queued) are skipped, as they could never be written. If it fails, or is
+        cancelled, the writes are put back unless they have been replaced by a newer write in the meantime."""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            await self.db.execute("""INSERT INTO mark_tbl (student_id, task_id, has_completed)
+SELECT s, t, c FROM unnest($1::int[], $2::int[], $3::bool[]) AS x(s, t, c)
+WHERE EXISTS (SELECT 1 FROM task WHERE id = t) AND EXISTS (SELECT 1 FROM student WHERE id = s)
+ON CONFLICT (student_id, task_id) DO UPDATE SET has_completed = EXCLUDED.has_completed;""",
+                [student_id for student_id, _ in pending], [task_id for _, task_id in pending], list(pending.values()))
+        except BaseException: # Includes CancelledError, so a flush cancelled on shutdown doesn't lose its batch
+            for key, has_completed in pending.items():
+                self.pending.setdefault(key, has_completed)
+            raise
+
+    async def close(self):
+        """Stops flushing in the background and flushes whatever is still pending, so nothing is lost on shutdown. A failure is
+        logged rather than raised, so the rest of the shutdown still happens."""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task # Waits for a flush that was running to put its batch back
+            except asyncio.CancelledError:
+                pass
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Flushing %d task completions on shutdown failed, they are lost", len(self.pending))